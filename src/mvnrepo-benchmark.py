@@ -0,0 +1,321 @@
+description = 'mvnrepo-benchmark.py measures mvnrepo-updater.py performance on synthetic manifests'
+usage = 'Usage: mvnrepo-benchmark.py [--sizes 10,1000,5000] [--e2e-sizes 10,100] [--runs N] [--output FILE] [--baseline FILE]'
+
+import sys
+import os.path
+import time
+import shutil
+import tempfile
+import subprocess
+
+script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+updater_script = os.path.join(script_dir, 'mvnrepo-updater.py')
+
+#Writes artifacts.txt with 'count' github urls spread over several organisations
+def writeManifest(path, count):
+    urls_file = open(path, 'w')
+    for index in range(count):
+        urls_file.write('git://github.com/org%d/artifact-%05d.git\n' % (index % 50, index))
+    urls_file.close()
+
+#Copy of mvnrepo-updater.py with synthetic artifacts.txt next to it (manifest is read from script dir)
+def prepareWorkDir(count):
+    work_dir = tempfile.mkdtemp(prefix='mvnrepo-benchmark-')
+    shutil.copy(updater_script, work_dir)
+    writeManifest(os.path.join(work_dir, 'artifacts.txt'), count)
+    apps_dir = os.path.join(work_dir, 'apps')
+    os.makedirs(apps_dir)
+    return (work_dir, apps_dir)
+
+#Runs mvnrepo-updater.py, returns seconds it took. Exit code and end of stderr of failed run are put to
+#failed[step] (step defaults to arguments)
+def runUpdater(work_dir, apps_dir, args, failed, step=None, env=None):
+    cmd = [sys.executable, os.path.join(work_dir, 'mvnrepo-updater.py'), '-a', apps_dir] + args
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(cmd, stdout=devnull, stderr=subprocess.PIPE, cwd=work_dir, env=env)
+        errors = process.communicate()[1]
+    elapsed = time.time() - start
+    if process.returncode:
+        failed[step or ' '.join(args)] = {'code': process.returncode,
+                                          'stderr': errors.decode('utf-8', 'replace')[-2000:]}
+    return elapsed
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+#Startup time of quick commands: 'cold' - manifest cache is rebuilt, 'warm' - loaded from cache
+def benchmarkStartup(count, runs):
+    (work_dir, apps_dir) = prepareWorkDir(count)
+    cache = os.path.join(work_dir, 'artifacts.txt.cache')
+    try:
+        results = dict()
+        failed = dict()
+        for (name, args) in (('list_dirs', ['-l', '*']), ('list_one', ['-l', 'artifact-00000'])):
+            cold = list()
+            warm = list()
+            for run in range(runs):
+                if os.path.exists(cache):
+                    os.remove(cache)
+                cold.append(runUpdater(work_dir, apps_dir, args, failed, name + '_cold'))
+                warm.append(runUpdater(work_dir, apps_dir, args, failed, name + '_warm'))
+            results[name] = {'cold_ms': round(median(cold) * 1000, 1), 'warm_ms': round(median(warm) * 1000, 1)}
+        if failed:
+            results['failed'] = failed
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+#Fresh copy of mvnrepo-updater.py module, so Repository of every run starts empty
+def loadUpdater(path):
+    if sys.version_info[0] < 3:
+        import imp
+        return imp.load_source('mvnrepo_updater', path)
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('mvnrepo_updater', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+#Manifest loading and artifact selection inside one process: Repository.loadFromFile (cold - cache is rebuilt,
+#warm - loaded from cache) and Repository.resolve/resolveOne with 100 selectors of each kind
+def benchmarkSelection(count, runs):
+    (work_dir, apps_dir) = prepareWorkDir(count)
+    manifest = os.path.join(work_dir, 'artifacts.txt')
+    indexes = [index * count // min(count, 100) for index in range(min(count, 100))]
+    names = ['artifact-%05d' % index for index in indexes]
+    paths = ['org%d/artifact-%05d' % (index % 50, index) for index in indexes]
+    timings = dict()
+    def measure(name, callback):
+        start = time.time()
+        callback()
+        timings.setdefault(name, list()).append(time.time() - start)
+    try:
+        for run in range(runs):
+            if os.path.exists(manifest + '.cache'):
+                os.remove(manifest + '.cache')
+            for load in ('load_cold_ms', 'load_warm_ms'):
+                updater = loadUpdater(os.path.join(work_dir, 'mvnrepo-updater.py'))
+                measure(load, lambda: updater.Repository.loadFromFile(manifest))
+            repository = updater.Repository
+            measure('resolve_all_ms', lambda: repository.resolve('*', list()))
+            measure('resolve_glob_100_ms', lambda: [repository.resolve('org%d/*' % (index % 50), list()) for index in range(100)])
+            measure('resolve_substring_100_ms', lambda: [repository.resolve(name[-5:], list()) for name in names * (100 // len(names))])
+            measure('resolve_one_100_ms', lambda: [repository.resolveOne(name) for name in names * (100 // len(names))])
+            measure('resolve_one_path_100_ms', lambda: [repository.resolveOne(path) for path in paths * (100 // len(paths))])
+        return dict((name, round(median(values) * 1000, 2)) for (name, values) in timings.items())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+#Bare repository with one commit of pom.xml, written directly as loose objects: thousands of remotes are created
+#in seconds without starting git
+def writeBareRepo(path, pom):
+    import zlib
+    import hashlib
+    import binascii
+    def writeObject(kind, content):
+        data = ('%s %d\0' % (kind, len(content))).encode('ascii') + content
+        sha = hashlib.sha1(data).hexdigest()
+        directory = os.path.join(path, 'objects', sha[:2])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, sha[2:]), 'wb') as object_file:
+            object_file.write(zlib.compress(data))
+        return sha
+    blob = writeObject('blob', pom.encode('utf-8'))
+    tree = writeObject('tree', b'100644 pom.xml\0' + binascii.unhexlify(blob))
+    signature = 'Benchmark <benchmark@localhost> 1300000000 +0000'
+    commit = writeObject('commit', ('tree %s\nauthor %s\ncommitter %s\n\nSynthetic artifact\n' % (tree, signature, signature)).encode('ascii'))
+    os.makedirs(os.path.join(path, 'refs', 'heads'))
+    os.makedirs(os.path.join(path, 'refs', 'tags'))
+    for (name, content) in (('HEAD', 'ref: refs/heads/master\n'), ('config', '[core]\n\trepositoryformatversion = 0\n\tbare = true\n'),
+                            (os.path.join('refs', 'heads', 'master'), commit + '\n')):
+        with open(os.path.join(path, name), 'w') as ref_file:
+            ref_file.write(content)
+
+#Pom of synthetic artifact, artifact N depends on artifact (N - 1) / 2: dependency tree of log2(count) levels
+def getPom(index):
+    dependencies = ''
+    if index:
+        dependencies = ('<dependency><groupId>benchmark</groupId><artifactId>artifact-%05d</artifactId>'
+                        '<version>1.0</version></dependency>' % ((index - 1) // 2))
+    return ('<project><modelVersion>4.0.0</modelVersion><groupId>benchmark</groupId><artifactId>artifact-%05d</artifactId>'
+            '<version>1.0</version><dependencies>%s</dependencies></project>\n' % (index, dependencies))
+
+#Stub mvnd: builds of each daemon registry (-Dmvnd.daemonStorage slot dir) are counted in stub-builds of the slot,
+#'--status' reports 100 MB of resident memory per build of running daemon, '--stop' resets the count.
+#Most builds the daemon of slot did before its stop is kept in stub-max, number of stops in stub-stops
+stub_mvnd = '''#!/bin/sh
+slot=.
+for arg in "$@"; do case "$arg" in -Dmvnd.daemonStorage=*) slot="${arg#*=}";; esac; done
+builds=$(cat "$slot/stub-builds" 2>/dev/null || echo 0)
+case " $* " in
+*" --stop "*) echo 0 > "$slot/stub-builds"; echo stop >> "$slot/stub-stops"; exit 0;;
+*" --status "*) echo "ID PID Address Status RSS Last activity Java home"
+    [ "$builds" -gt 0 ] && echo "stub 1 inet:127.0.0.1:1 Idle $((builds * 100))m - -"; exit 0;;
+esac
+builds=$((builds + 1))
+echo $builds > "$slot/stub-builds"
+[ $builds -gt $(cat "$slot/stub-max" 2>/dev/null || echo 0) ] && echo $builds > "$slot/stub-max"
+echo "[INFO] stub mvnd $*"
+sleep %s
+echo "[INFO] BUILD SUCCESS"
+'''
+
+#Local fake github for artifacts of writeManifest(): bare repositories in work_dir/remotes, git url rewrite
+#(git://github.com/ -> remotes dir) in gitconfig of work_dir/home, stub mvn sleeping 'latency' seconds and stub mvnd.
+#Returns environment for mvnrepo-updater.py, urls in artifacts.txt stay github urls
+def prepareFakeRemotes(work_dir, count, latency):
+    remotes = os.path.join(work_dir, 'remotes')
+    for index in range(count):
+        writeBareRepo(os.path.join(remotes, 'org%d' % (index % 50), 'artifact-%05d.git' % index), getPom(index))
+    home = os.path.join(work_dir, 'home')
+    os.makedirs(home)
+    with open(os.path.join(home, '.gitconfig'), 'w') as gitconfig:
+        gitconfig.write('[user]\n\tname = Benchmark\n\temail = benchmark@localhost\n'
+                        '[url "%s/"]\n\tinsteadOf = git://github.com/\n' % remotes)
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    for (name, script) in (('mvn', '#!/bin/sh\necho "[INFO] stub mvn $*"\nsleep %s\necho "[INFO] BUILD SUCCESS"\n'),
+                           ('mvnd', stub_mvnd)):
+        with open(os.path.join(bin_dir, name), 'w') as stub_file:
+            stub_file.write(script % latency)
+        os.chmod(os.path.join(bin_dir, name), int('755', 8))
+    env = dict(os.environ)
+    env.update({'HOME': home, 'XDG_CONFIG_HOME': os.path.join(home, '.config'), 'GIT_CONFIG_NOSYSTEM': '1',
+                'PATH': bin_dir + os.pathsep + env.get('PATH', '')})
+    env.pop('GIT_CONFIG_GLOBAL', None)
+    return env
+
+#(most builds of a daemon before its stop, number of stops) over daemon slots of --executor daemon, since last call
+def readDaemonStats(apps_dir):
+    slots_dir = os.path.join(apps_dir, '.mvnrepo-updater-daemons')
+    (most, stops) = (0, 0)
+    for slot in os.path.isdir(slots_dir) and os.listdir(slots_dir) or []:
+        for (name, read) in (('stub-max', lambda text: int(text or 0)), ('stub-stops', lambda text: len(text.split()))):
+            path = os.path.join(slots_dir, slot, name)
+            if os.path.exists(path):
+                with open(path) as stats_file:
+                    value = read(stats_file.read().strip())
+                os.remove(path)
+                if name == 'stub-max':
+                    most = max(most, value)
+                else:
+                    stops += value
+    return (most, stops)
+
+#Commands of whole runs against fake remotes, in this order: clone all (-u), update of up to date working copies,
+#status scan (-s), branch urls (-L), deploy of all artifacts (-d), incremental deploy with nothing changed and
+#forced deploys with stub mvnd (--executor daemon) whose daemons must be recycled after 3 builds, by
+#--daemon-max-builds and then by --daemon-max-memory (stub daemon grows by 100 MB per build)
+def benchmarkEndToEnd(count, jobs, latency):
+    (work_dir, apps_dir) = prepareWorkDir(count)
+    try:
+        start = time.time()
+        env = prepareFakeRemotes(work_dir, count, latency)
+        results = {'remotes_s': round(time.time() - start, 2)}
+        failed = dict()
+        daemon = ['--executor', 'daemon', '--daemon-pool', '2', '--force', '-d', '*']
+        for (name, args) in (('update_clone', ['-u', '*']), ('update_noop', ['-u', '*']), ('status', ['-s', '*']),
+                             ('branch_urls', ['-L', '*']), ('deploy', ['-d', '*']), ('deploy_noop', ['-d', '*']),
+                             ('deploy_daemon', ['--daemon-max-builds', '3'] + daemon),
+                             ('deploy_daemon_memory', ['--daemon-max-memory', '250'] + daemon)):
+            results[name + '_s'] = round(runUpdater(work_dir, apps_dir, ['-j', str(jobs)] + args, failed, name, env), 2)
+            if name.startswith('deploy_daemon'):
+                (most, stops) = readDaemonStats(apps_dir)
+                if most > 3 or (count >= 6 and not stops):
+                    failed[name + '_recycling'] = {'code': None, 'stderr': 'Daemons were not recycled after 3 builds: '
+                                                   'up to %d builds of one daemon, %d stops' % (most, stops)}
+        cloned = len([name for org in os.listdir(apps_dir) if org.startswith('org')
+                      for name in os.listdir(os.path.join(apps_dir, org))])
+        if cloned != count:
+            failed['cloned'] = {'code': None, 'stderr': 'Only %d of %d artifacts were cloned from fake remotes' % (cloned, count)}
+        results['cloned'] = cloned
+        if failed:
+            results['failed'] = failed
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+#Flat {'section/size/name': value} of timings (keys ending with _ms or _s) in benchmark results
+def getTimings(results, prefix=''):
+    timings = dict()
+    for (key, value) in results.items():
+        if isinstance(value, dict):
+            timings.update(getTimings(value, prefix + key + '/'))
+        elif isinstance(value, (int, float)) and (key.endswith('_ms') or key.endswith('_s')):
+            timings[prefix + key] = value
+    return timings
+
+#Timings which are more than 'factor' times slower than in baseline results (tiny ones are too noisy to compare)
+def compareWithBaseline(results, baseline, factor):
+    regressions = list()
+    old = getTimings(baseline)
+    for (name, value) in sorted(getTimings(results).items()):
+        minimum = name.endswith('_s') and 0.5 or 5
+        if name in old and value > max(old[name], minimum) * factor:
+            regressions.append('%s: %s (baseline %s)' % (name, value, old[name]))
+    return regressions
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("--sizes", dest="sizes", default="10,1000,5000",
+        help="Comma separated numbers of artifacts in synthetic manifests", metavar="N,N")
+    parser.add_option("--e2e-sizes", dest="e2e_sizes", default="10,100",
+        help="Numbers of artifacts for end-to-end runs (-u, -s, -L, -d) against local fake remotes, empty to skip", metavar="N,N")
+    parser.add_option("--runs", type="int", dest="runs", default=5,
+        help="Runs of each measurement, median is reported", metavar="N")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=8,
+        help="--jobs of end-to-end runs (default 8)", metavar="N")
+    parser.add_option("--mvn-latency", type="float", dest="mvn_latency", default=0.1,
+        help="Seconds every call of stub mvn takes in end-to-end runs (default 0.1)", metavar="SECONDS")
+    parser.add_option("--max-startup-ms", type="float", dest="max_startup_ms",
+        help="Exit with code 1 if warm startup of any command is slower (regression check)", metavar="MS")
+    parser.add_option("--baseline", dest="baseline",
+        help="Exit with code 1 if any timing is --max-slowdown times slower than in JSON results of earlier run", metavar="FILE")
+    parser.add_option("--max-slowdown", type="float", dest="max_slowdown", default=1.5,
+        help="Allowed slowdown against --baseline (default 1.5)", metavar="FACTOR")
+    parser.add_option("-o", "--output", dest="output",
+        help="Write results as JSON to file", metavar="FILE")
+    (options, args) = parser.parse_args()
+
+    import json
+    results = {'python': sys.version.split()[0], 'startup': dict(), 'selection': dict(), 'e2e': dict()}
+    for size in [int(size) for size in options.sizes.split(',') if size]:
+        results['startup'][str(size)] = benchmarkStartup(size, options.runs)
+        results['selection'][str(size)] = benchmarkSelection(size, options.runs)
+    for size in [int(size) for size in options.e2e_sizes.split(',') if size]:
+        results['e2e'][str(size)] = benchmarkEndToEnd(size, options.jobs, options.mvn_latency)
+    output = json.dumps(results, indent=1, sort_keys=True)
+    print(output)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+
+    code = 0
+    for section in ('startup', 'e2e'):
+        for (size, steps) in sorted(results[section].items()):
+            for (name, failure) in sorted(steps.get('failed', dict()).items()):
+                status = failure['code'] is None and 'check failed' or 'exit code %s' % failure['code']
+                print('Failed %s step %s on %s artifacts (%s):\n%s' % (section, name, size, status, failure['stderr'].rstrip()))
+                code = 1
+    if options.max_startup_ms:
+        for (size, commands) in sorted(results['startup'].items()):
+            for (name, timing) in sorted(commands.items()):
+                if name != 'failed' and timing['warm_ms'] > options.max_startup_ms:
+                    print('Startup regression: %s on %s artifacts took %.1f ms (limit %.1f ms)'
+                          % (name, size, timing['warm_ms'], options.max_startup_ms))
+                    code = 1
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            regressions = compareWithBaseline(results, json.load(baseline_file), options.max_slowdown)
+        for regression in regressions:
+            print('Regression against %s: %s' % (options.baseline, regression))
+        if regressions:
+            code = 1
+    return code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,20 +6,27 @@ latest_version_url = "https://raw.github.com/Artem-Mamchych/mvnrepo-updater/mast
 #Created on Dec 01, 2011
 #Author: Artem Mamchych
 import sys
-import subprocess
 import os.path
+import threading
+import time
 
 version_string = "%s version: %s  Latest version available at:\n %s" % (sys.argv[0], str(version), latest_version_url)
 home_dir = os.getcwd()
 options = None
 maven_opts = " "
-log_file = None
 warnings = list()
 executed_commands = list()
+failures = list()
+command_timings = list()
 artifacts_file = 'artifacts.txt'
+manifest_cache_version = 2
+#Per-thread state: artifact being processed and its working dir (replaces process-global os.chdir)
+context = threading.local()
+output_lock = threading.RLock()
+#Position of each selected artifact, used to keep summaries deterministic when --jobs > 1
+run_order = dict()
 
 def initArtifacts():
-    applicationStabilityTest()
     Repository.loadFromFile(os.path.join(os.path.dirname(sys.argv[0]), artifacts_file))
 
 #Ckecks in runtime stability of most critical parts of this script
@@ -35,6 +42,15 @@ def applicationStabilityTest():
     http2 = Artifact('https://Artem-Mamchych@github.com/Artem-Mamchych/mvnrepo-updater.git')
     assert http2.baseUrl == 'github.com' and http2.organisation == 'Artem-Mamchych' and http2.name == 'mvnrepo-updater', 'Artifact.parseScmUrl(https_url) is broken!'
 
+def currentArtifact():
+    return getattr(context, 'artifact', None)
+
+def getCwd():
+    cwd = getattr(context, 'cwd', None)
+    if cwd:
+        return cwd
+    return os.getcwd()
+
 def isGitRepo(dir):
     if isinstance(dir, Artifact):
         dir = dir.getAbsoluteLocationDir()
@@ -48,71 +64,525 @@ def isUncommittedChangesExists():
 def getBranchName():
     if options.echoMode:
         return 'master'
-    current_branch = callAndGetOutput('git symbolic-ref -q HEAD', log=False)
+    metadata = GitMetadata.forDir(getCwd())
+    if metadata:
+        current_branch = metadata.getHeadRef() or ''
+    else:
+        current_branch = callAndGetOutput('git symbolic-ref -q HEAD', log=False)
     if not current_branch.startswith("refs/heads/"):
-        fatal('Failed to get current branch name in dir ' + os.getcwd())
+        fatal('Failed to get current branch name in dir ' + getCwd())
         sys.exit(1)
     current_branch = current_branch.replace("refs/heads/","")
     current_branch = current_branch.rstrip()
     return current_branch
 
 def isLocalBranchExists(branchName):
+    metadata = GitMetadata.forDir(getCwd())
+    if metadata:
+        return metadata.resolveRef('refs/heads/' + branchName) is not None
     return not call('git show-ref --verify --quiet refs/heads/"%s"' % branchName, log=False)
 
+def getHeadCommit():
+    metadata = GitMetadata.forDir(getCwd())
+    if metadata:
+        commit = metadata.getHeadCommit()
+        if commit:
+            return commit
+    return callAndGetOutput('git rev-parse HEAD', log=False).strip()
+
+#Reads HEAD, refs and remotes straight from .git dir, without starting git processes.
+#Parsed files are cached per repository and re-read when their mtime or size changes.
+#forDir() returns None for layouts which are not supported (worktrees, submodules, reftable) - use git commands for them
+class GitMetadata(object):
+    repositories = dict()
+    lock = threading.Lock()
+
+    def __init__(self, gitDir):
+        self.gitDir = gitDir
+        self.files = dict() #file name -> ((mtime, size), parsed content)
+
+    @staticmethod
+    def forDir(path):
+        return GitMetadata.forGitDir(os.path.join(path, '.git'))
+
+    @staticmethod
+    def forGitDir(gitDir):
+        with GitMetadata.lock:
+            metadata = GitMetadata.repositories.get(gitDir)
+            if metadata is None:
+                metadata = GitMetadata(gitDir)
+                if not metadata.isSupported():
+                    metadata = False
+                GitMetadata.repositories[gitDir] = metadata
+        return metadata or None
+
+    def isSupported(self):
+        if not os.path.isdir(self.gitDir): #'.git' file of worktree or submodule
+            return False
+        if os.path.exists(os.path.join(self.gitDir, 'commondir')) or os.path.exists(os.path.join(self.gitDir, 'reftable')):
+            return False
+        extensions = self.getConfig().get('extensions', dict())
+        return 'refstorage' not in extensions and 'worktreeconfig' not in extensions
+
+    #Returns parser(text) for file in .git dir (None if file not exists or is not a regular file, like
+    #refs/heads/feature dir of feature/x branch), re-parsed only if file has changed
+    def read(self, name, parser):
+        import stat
+        path = os.path.join(self.gitDir, name)
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return parser(None)
+        if not stat.S_ISREG(file_stat.st_mode):
+            return parser(None)
+        stamp = (file_stat.st_mtime, file_stat.st_size)
+        cached = self.files.get(name)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        try:
+            with open(path) as git_file:
+                text = git_file.read()
+        except (IOError, OSError): #removed or replaced by dir since stat
+            return parser(None)
+        parsed = parser(text)
+        self.files[name] = (stamp, parsed)
+        return parsed
+
+    #'refs/heads/<branch>' or None if HEAD is detached
+    def getHeadRef(self):
+        head = self.read('HEAD', lambda text: (text or '').strip())
+        if head.startswith('ref:'):
+            return head[4:].strip()
+        return None
+
+    def getHeadCommit(self):
+        head = self.read('HEAD', lambda text: (text or '').strip())
+        if head.startswith('ref:'):
+            return self.resolveRef(head[4:].strip())
+        return head or None
+
+    #Commit id of ref from loose ref file or packed-refs, None if ref not exists
+    def resolveRef(self, ref):
+        loose = self.read(ref, lambda text: text and text.strip())
+        if loose:
+            if loose.startswith('ref:'):
+                return self.resolveRef(loose[4:].strip())
+            return loose
+        return self.read('packed-refs', parsePackedRefs).get(ref)
+
+    def getConfig(self):
+        return self.read('config', parseGitConfig)
+
+    def getRemotes(self):
+        return sorted(key[1] for key in self.getConfig() if isinstance(key, tuple) and key[0] == 'remote')
+
+    def getRemoteUrl(self, remote):
+        return self.getConfig().get(('remote', remote), dict()).get('url')
+
+def parsePackedRefs(text):
+    refs = dict()
+    for line in (text or '').splitlines():
+        if line and line[0] not in '#^':
+            parts = line.split(' ', 1)
+            if len(parts) == 2:
+                refs[parts[1].strip()] = parts[0]
+    return refs
+
+#Parses git config into {'section': {key: value}} and {('section', 'subsection'): {key: value}}. Keys are lowercase
+def parseGitConfig(text):
+    config = dict()
+    section = config.setdefault('', dict())
+    for line in (text or '').splitlines():
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line.startswith('[') and ']' in line:
+            header = line[1:line.index(']')].strip()
+            if '"' in header:
+                (name, subsection) = header.split('"', 1)
+                key = (name.strip().lower(), subsection.rstrip('"'))
+            else:
+                key = header.lower()
+            section = config.setdefault(key, dict())
+        elif '=' in line:
+            (name, value) = line.split('=', 1)
+            section[name.strip().lower()] = value.strip().strip('"')
+        else:
+            section[line.lower()] = 'true'
+    return config
+
 def switchBranch(artifact):
     branch = artifact.branch
     if not branch:
         return True
     if isUncommittedChangesExists():
         fatal(artifact.name + ' contains uncommitted changes. Failed to change branch')
+        Journal.record(artifact, 'switch', False)
         return False
     if branch:
         if artifact.remote == 'upstream' and isLocalBranchExists(branch):
             call('git checkout "%s"' % branch)
         else:
-            if artifact.remote != 'upstream':
-                call('git remote add %s %s' % (artifact.remote, artifact.getGitHubROUrl(artifact.remote)))
-            call('git fetch -v ' + artifact.remote)
-            call('git checkout -f --track -b "%s-%s" remotes/%s/%s' % (branch, artifact.remote, artifact.remote, branch))
+            addRemote(artifact, artifact.remote)
+            if not trackUpstreamBranch(artifact):
+                fetchBranchRemotes(artifact, [artifact.remote])
+            local_branch = '%s-%s' % (branch, artifact.remote)
+            if isLocalBranchExists(local_branch):
+                call('git checkout -f "%s"' % local_branch)
+                call('git merge --ff-only remotes/%s/%s' % (artifact.remote, branch))
+            else:
+                call('git checkout -f --track -b "%s" remotes/%s/%s' % (local_branch, artifact.remote, branch))
 #        if not getBranchName() == branch:
 #            fatal('Failed to change branch to: ' + branch + ' in ' + artifact.name)
 #            return False
+    Journal.record(artifact, 'switch', True)
+    return True
+
+#Single-branch clones (see getCloneOptions()) fetch only upstream branches listed in remote.upstream.fetch.
+#Adds branch of artifact there and fetches it (as 'upstream:<branch>' of fetch ledger, see fetchRemotes()).
+#Returns False if all upstream branches are fetched anyway
+def trackUpstreamBranch(artifact):
+    if artifact.remote != 'upstream' or options.mirror_dir or options.echoMode:
+        return False
+    metadata = GitMetadata.forDir(getCwd())
+    if metadata and '*' in metadata.getConfig().get(('remote', 'upstream'), dict()).get('fetch', '*'):
+        return False
+    refspecs = (callAndGetOutput('git config --get-all remote.upstream.fetch', log=False) or '').split()
+    if not refspecs or [refspec for refspec in refspecs if '*' in refspec]:
+        return False
+    if not [refspec for refspec in refspecs if refspec.endswith(':refs/remotes/upstream/' + artifact.branch)]:
+        call('git remote set-branches --add upstream "%s"' % artifact.branch)
+    def fetch(names):
+        branches = [name[len('upstream:'):] for name in names]
+        return call('git fetch -v upstream ' + ' '.join('"+refs/heads/%s:refs/remotes/upstream/%s"' % (branch, branch) for branch in branches))
+    fetchRemotes(os.path.join(getCwd(), '.git'), ['upstream:' + artifact.branch], fetch)
     return True
 
+def addRemote(artifact, remote):
+    if remote != 'upstream' and not isRemoteExists(remote):
+        call('git remote add %s %s' % (remote, artifact.getGitHubROUrl(remote)))
+
+#Fetches remotes into working copy of artifact (through mirror if --mirror-dir is set), see fetchRemotes()
+def fetchBranchRemotes(artifact, remotes):
+    if options.mirror_dir:
+        return fetchFromMirror(artifact, remotes)
+    return fetchRemotes(os.path.join(getCwd(), '.git'), remotes, lambda names: call('git fetch -v --multiple ' + ' '.join(names)))
+
+#Fetches remotes needed to switch branches of selected artifacts before actions run, one 'git fetch --multiple'
+#per repository, so the same repository selected with several branches is fetched once
+def prefetchBranchRemotes(selection):
+    targets = dict()
+    repos = list()
+    for artifact in selection:
+        if artifact.branch and isGitRepo(artifact):
+            if artifact.getLocationDir() not in targets:
+                targets[artifact.getLocationDir()] = list()
+                repos.append(artifact)
+            targets[artifact.getLocationDir()].append(artifact)
+    def prefetch(repo):
+        changeDir(repo)
+        remotes = list()
+        for artifact in targets[repo.getLocationDir()]:
+            if artifact.remote == 'upstream' and (isLocalBranchExists(artifact.branch) or trackUpstreamBranch(artifact)):
+                continue
+            addRemote(artifact, artifact.remote)
+            if artifact.remote not in remotes:
+                remotes.append(artifact.remote)
+        if remotes:
+            fetchBranchRemotes(repo, remotes)
+    runParallel(repos, prefetch, getJobs(), phase='fetch')
+
+#Fetch ledger: time of last successful fetch of each remote, kept in <git dir>/mvnrepo-updater-fetch.json.
+#Remotes fetched within --fetch-ttl seconds (or already fetched in this run) are skipped, remotes which are being
+#fetched by another thread are waited for, the rest is fetched by single fetch(remotes) call
+fetch_ledger_file = 'mvnrepo-updater-fetch.json'
+fetches_in_progress = dict() #(git dir, remote) -> threading.Event
+fetched_in_run = set()
+
+def fetchRemotes(gitDir, remotes, fetch, ttl=None):
+    import json
+    if ttl is None:
+        ttl = options.fetch_ttl
+    ledger_path = os.path.join(gitDir, fetch_ledger_file)
+    now = time.time()
+    to_fetch = list()
+    to_wait = list()
+    with output_lock:
+        ledger = readFetchLedger(ledger_path)
+        for remote in remotes:
+            key = (gitDir, remote)
+            if remote in to_fetch:
+                continue
+            if key in fetches_in_progress:
+                to_wait.append(fetches_in_progress[key])
+            elif key in fetched_in_run or now - ledger.get(remote, 0) < ttl:
+                log('Fetch of %s skipped, fetched %d seconds ago' % (remote, now - ledger.get(remote, now)))
+            else:
+                fetches_in_progress[key] = threading.Event()
+                to_fetch.append(remote)
+    code = 0
+    try:
+        if to_fetch:
+            code = fetch(to_fetch)
+            if not code and not options.echoMode and os.path.isdir(gitDir):
+                with output_lock:
+                    ledger = readFetchLedger(ledger_path)
+                    for remote in to_fetch:
+                        ledger[remote] = now
+                        fetched_in_run.add((gitDir, remote))
+                    writeFileAtomically(ledger_path, json.dumps(ledger))
+    finally:
+        with output_lock:
+            for remote in to_fetch:
+                fetches_in_progress.pop((gitDir, remote)).set()
+    for event in to_wait:
+        event.wait()
+    return code
+
+def readFetchLedger(path):
+    import json
+    try:
+        with open(path) as ledger_file:
+            return json.load(ledger_file)
+    except (IOError, OSError, ValueError):
+        return dict()
+
+#Sets working dir for all commands called from current thread
 def changeDir(artifact_home):
     if isinstance(artifact_home, Artifact):
+        context.artifact = artifact_home
         artifact_home = artifact_home.getAbsoluteLocationDir()
     if not os.path.exists(artifact_home):
-        os.makedirs(artifact_home)
-    os.chdir(artifact_home)
+        try:
+            os.makedirs(artifact_home)
+        except OSError:
+            if not os.path.isdir(artifact_home): #created by another worker
+                raise
+    context.cwd = artifact_home
     if options and options.debug_mode:
-        log("We are in " + os.path.realpath('.'))
+        log("We are in " + os.path.realpath(artifact_home))
 
 def gitCloneOrUpdate(repo):
     changeDir(repo)
     if not isGitRepo(repo):
-        log("Cloning repo: " + repo.getScmUrl() + ' into ' + os.getcwd())
-        call('git clone --progress -v ' + repo.getScmUrl() + ' .')
+        log("Cloning repo: " + repo.getScmUrl() + ' into ' + getCwd())
+        clone_options = getCloneOptions(repo)
+        if options.mirror_dir:
+            code = call('git clone --progress -v%s --reference-if-able "%s" --dissociate %s .'
+                        % (getCloneArguments(clone_options), updateMirror(repo, ttl=0), repo.getScmUrl()))
+        else:
+            code = call('git clone --progress -v%s %s .' % (getCloneArguments(clone_options), repo.getScmUrl()))
+        if 'sparse' in clone_options:
+            call('git sparse-checkout set --cone ' + ' '.join(clone_options['sparse'].split(',')))
         call('git remote rename origin upstream')
         if options.github_username:
             call('git remote add %s %s' % (options.github_username, repo.getSshForkUrl()) )
+        setUpdateResult(repo, 'cloned')
+        Journal.record(repo, 'update', not code)
     else:
         gitReset(repo)
         if isUncommittedChangesExists():
             warning(repo.getLocationDir() + " contains uncommitted changes, update skipped!")
+            setUpdateResult(repo, 'skipped')
+            Journal.record(repo, 'update', None)
+        elif isUpToDateWithRemote(repo):
+            log("Repo is up to date: " + repo.getScmUrl())
+            setUpdateResult(repo, 'up to date')
+            code = 0
+            #master may have been pulled by earlier -u, branch still needs rebase
+            if options.rebase and getBranchName() != "master" and call('git merge-base --is-ancestor master HEAD', log=False, quiet=True):
+                deepenForRebase(repo)
+                code = call('git rebase master')
+            Journal.record(repo, 'update', not code)
         else:
             log("Updating repo: " + repo.getScmUrl())
+            setUpdateResult(repo, 'updated')
+            #pulled through upstream/master, so ahead/behind of 'git status' (see getRepoStatus()) follows the pull
+            pull = 'git pull upstream +refs/heads/master:refs/remotes/upstream/master'
+            if options.mirror_dir:
+                pull = 'git pull "%s" +refs/heads/master:refs/remotes/upstream/master' % updateMirror(repo, ttl=0)
             current_branch = getBranchName()
             if current_branch == "master":
-                call('git pull ' + repo.getScmUrl())
+                code = call(pull)
             else:
                 call('git checkout master')
-                call('git pull ' + repo.getScmUrl())
+                code = call(pull)
                 call('git checkout ' + current_branch)
                 if options.rebase:
-                    call('git rebase master')
+                    deepenForRebase(repo)
+                    code = call('git rebase master') or code
                 else:
                     warning(repo.getLocationDir() + " is updated. Rebase your branches. (git rebase master)")
+            Journal.record(repo, 'update', not code)
+
+#Clone options of artifacts.txt line: 'depth=N', 'filter=SPEC', 'single-branch' and 'sparse=PATH,PATH'
+clone_option_names = ('depth', 'filter', 'single-branch', 'sparse')
+
+def parseCloneOptions(tokens, line):
+    clone_options = dict()
+    for token in tokens:
+        (name, value) = (token.split('=', 1) + ['true'])[:2]
+        if name not in clone_option_names or (name == 'depth' and not value.isdigit()):
+            fatal("Failed to parse clone option '%s' of artifact: %s" % (token, line))
+            sys.exit(2)
+        clone_options[name] = value
+    return clone_options or None
+
+#Clone options of artifact: options of artifacts.txt line override --depth, --filter, --single-branch and --sparse,
+#'depth=0', 'filter=none', 'single-branch=false' and 'sparse=' turn global option off
+def getCloneOptions(artifact):
+    clone_options = dict()
+    if options.depth:
+        clone_options['depth'] = str(options.depth)
+    if options.clone_filter:
+        clone_options['filter'] = options.clone_filter
+    if options.single_branch:
+        clone_options['single-branch'] = 'true'
+    if options.sparse:
+        clone_options['sparse'] = options.sparse
+    clone_options.update(artifact.cloneOptions or dict())
+    return dict((name, value) for (name, value) in clone_options.items() if value not in ('0', 'none', 'false', ''))
+
+def getCloneArguments(clone_options):
+    arguments = ''
+    if 'depth' in clone_options:
+        arguments += ' --depth ' + clone_options['depth']
+    if 'filter' in clone_options:
+        arguments += ' --filter=' + clone_options['filter']
+    if 'single-branch' in clone_options:
+        arguments += ' --single-branch'
+    if 'sparse' in clone_options:
+        arguments += ' --sparse'
+    return arguments
+
+#'git rebase master' needs common ancestor of current branch and master. Shallow clone may not have it, so its history
+#is deepened (from mirror if --mirror-dir is set) until it's found, clone is unshallowed as the last resort
+def deepenForRebase(repo):
+    if options.echoMode or not os.path.exists(os.path.join(getCwd(), '.git', 'shallow')):
+        return
+    source = 'upstream'
+    if options.mirror_dir:
+        source = '"%s"' % getMirrorPath(repo)
+    depth = 64
+    while call('git merge-base HEAD master', log=False, quiet=True):
+        if depth > 4096:
+            log('Unshallowing %s to rebase %s' % (repo.getLocationDir(), getBranchName()))
+            call('git fetch --unshallow ' + source)
+            return
+        log('Deepening history of %s by %d commits to rebase %s' % (repo.getLocationDir(), depth, getBranchName()))
+        call('git fetch --deepen=%d %s' % (depth, source))
+        depth *= 4
+
+#Remote HEAD commits of repositories (location -> commit id) read by readRemoteHeads() before update, and update results
+remote_heads = dict()
+update_results = dict()
+
+#Reads HEAD commit of upstream of all cloned repos with concurrent 'git ls-remote' calls
+def readRemoteHeads(repos):
+    if options.echoMode:
+        return
+    def readHead(repo):
+        changeDir(repo)
+        output = callAndGetOutput('git ls-remote %s HEAD' % repo.getScmUrl(), log=False)
+        for line in (output or '').splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1] == 'HEAD':
+                with output_lock:
+                    remote_heads[repo.getLocationDir()] = parts[0]
+    runParallel([repo for repo in repos if isGitRepo(repo)], readHead, getJobs(8), phase='ls-remote')
+
+#True if upstream HEAD read by readRemoteHeads() is local master or one of its ancestors (nothing to pull)
+def isUpToDateWithRemote(repo):
+    head = remote_heads.get(repo.getLocationDir())
+    if not head:
+        return False
+    metadata = GitMetadata.forDir(getCwd())
+    if metadata:
+        master = metadata.resolveRef('refs/heads/master')
+    else:
+        master = callAndGetOutput('git rev-parse -q --verify refs/heads/master', log=False).strip()
+    if master == head:
+        return True
+    return bool(master) and call('git merge-base --is-ancestor %s %s' % (head, master), log=False, quiet=True) == 0
+
+def setUpdateResult(repo, result):
+    with output_lock:
+        update_results[repo.getLocationDir()] = result
+
+def showUpdateSummary():
+    if update_results:
+        counts = dict()
+        for result in update_results.values():
+            counts[result] = counts.get(result, 0) + 1
+        print('Repositories: %d up to date, %d updated, %d cloned, %d skipped (uncommitted changes)'
+              % (counts.get('up to date', 0), counts.get('updated', 0), counts.get('cloned', 0), counts.get('skipped', 0)))
+        update_results.clear()
+
+#Bare mirror of artifact repository in --mirror-dir, shared by its clones and fork remotes. Upstream branches are
+#kept in refs/heads, branches of fork remotes in refs/remotes/<remote>. Clones copy its objects (--reference
+#--dissociate, so 'git gc' of mirror never breaks them) and fetch from it, network is used only to update mirror
+mirror_locks = dict()
+
+def getMirrorPath(artifact):
+    return os.path.join(os.path.abspath(options.mirror_dir), artifact.baseUrl, artifact.organisation, artifact.name + '.git')
+
+#Creates mirror or fetches remotes into it (upstream is mirror's 'origin'), see fetchRemotes() for ttl. Returns mirror path
+def updateMirror(artifact, remotes=('upstream',), ttl=None):
+    path = getMirrorPath(artifact)
+    with output_lock:
+        lock = mirror_locks.setdefault(path, threading.Lock())
+    with lock:
+        if not os.path.isdir(path):
+            log('Creating mirror of %s in %s' % (artifact.getScmUrl(), path))
+            call('git clone --bare --progress %s "%s"' % (artifact.getScmUrl(), path))
+            call('git --git-dir="%s" config remote.origin.fetch "+refs/heads/*:refs/heads/*"' % path)
+            remotes = [remote for remote in remotes if remote != 'upstream']
+        metadata = GitMetadata.forGitDir(path)
+        for remote in remotes:
+            if remote != 'upstream' and (not metadata or remote not in metadata.getRemotes()):
+                call('git --git-dir="%s" remote add %s %s' % (path, remote, getRemoteUrl(artifact, remote)))
+    if remotes:
+        fetchRemotes(path, remotes, lambda names: call('git --git-dir="%s" fetch --prune --multiple %s'
+            % (path, ' '.join(name == 'upstream' and 'origin' or name for name in names))), ttl)
+    return path
+
+def getMirrorRefs(remote):
+    if remote == 'upstream':
+        return 'refs/heads/*'
+    return 'refs/remotes/%s/*' % remote
+
+#Fetches remote branches from mirror (mirror is updated from network first) into refs/remotes/<remote> of working copy
+def fetchFromMirror(artifact, remotes):
+    path = updateMirror(artifact, remotes)
+    refspecs = ['"+%s:refs/remotes/%s/*"' % (getMirrorRefs(remote), remote) for remote in remotes]
+    return call('git fetch -v "%s" %s' % (path, ' '.join(refspecs)))
+
+#Url of working copy remote, or github read-only url of fork if working copy doesn't have it
+def getRemoteUrl(artifact, remote):
+    metadata = GitMetadata.forDir(artifact.getAbsoluteLocationDir())
+    url = metadata and metadata.getRemoteUrl(remote)
+    if url:
+        return url
+    if remote == 'upstream':
+        return artifact.getScmUrl()
+    return artifact.getGitHubROUrl(remote)
+
+#Fetches upstream and all fork remotes of working copy into mirror
+def refreshMirror(artifact):
+    if not options.mirror_dir:
+        fatal('Mirror dir is not set, use --mirror-dir')
+        return
+    metadata = isGitRepo(artifact) and GitMetadata.forDir(artifact.getAbsoluteLocationDir())
+    remotes = ['upstream'] + [remote for remote in metadata and metadata.getRemotes() or [] if remote != 'upstream']
+    updateMirror(artifact, remotes, ttl=0)
+
+def gcMirror(artifact):
+    if not options.mirror_dir:
+        fatal('Mirror dir is not set, use --mirror-dir')
+        return
+    path = getMirrorPath(artifact)
+    if os.path.isdir(path):
+        call('git --git-dir="%s" gc --prune=now --quiet' % path)
 
 def gitReset(repo):
     if options.resetGitRepos and isGitRepo(repo):
@@ -120,17 +590,96 @@ def gitReset(repo):
             call('git diff > reverted_changes.diff')
         call('echo git reset --hard')
 
-def listStatus(artifact):
-    if isUncommittedChangesExists():
-        print(artifact.name)
-        print("UNCOMMITTED FILES; Branch: "+ getBranchName())
+#Branch, ahead/behind and changed files counts of artifact working copy, from single 'git status' call
+#('failed' is set if git status didn't work in it)
+def getRepoStatus(artifact):
+    status = {'artifact': artifact.name, 'location': artifact.getLocationDir(), 'cloned': isGitRepo(artifact),
+              'branch': None, 'upstream': None, 'ahead': 0, 'behind': 0,
+              'staged': 0, 'changed': 0, 'untracked': 0, 'conflicts': 0, 'failed': False}
+    if not status['cloned'] or options.echoMode:
+        return status
+    changeDir(artifact)
+    output = callAndGetOutput('git status --porcelain=v2 --branch --untracked-files=all', log=False)
+    if not output: #None if git couldn't be started, '' if it failed ('# branch.oid' line is always printed)
+        warning('%s: git status failed in %s' % (artifact.name, artifact.getLocationDir()))
+        status['failed'] = True
+        return status
+    for line in output.splitlines():
+        if line.startswith('# branch.head '):
+            status['branch'] = line[len('# branch.head '):]
+        elif line.startswith('# branch.upstream '):
+            status['upstream'] = line[len('# branch.upstream '):]
+        elif line.startswith('# branch.ab '):
+            (ahead, behind) = line[len('# branch.ab '):].split()
+            status['ahead'] = int(ahead)
+            status['behind'] = abs(int(behind))
+        elif line.startswith('1 ') or line.startswith('2 '):
+            if line[2] != '.':
+                status['staged'] += 1
+            if line[3] != '.':
+                status['changed'] += 1
+        elif line.startswith('u '):
+            status['conflicts'] += 1
+        elif line.startswith('? '):
+            status['untracked'] += 1
+    return status
+
+#Uncloned working copies are neither clean nor dirty, they are counted separately
+def isRepoStatusClean(status):
+    return not (status['failed'] or status['ahead'] or status['behind'] or status['staged']
+                or status['changed'] or status['untracked'] or status['conflicts'])
 
 def isRemoteExists(remote):
+    metadata = GitMetadata.forDir(getCwd())
+    if metadata:
+        return remote in metadata.getRemotes()
     remotes = callAndGetOutput('git remote show', log=False)
-    print("remotes " + remotes)
-    return remote in remotes
+    log("remotes " + remotes)
+    return remote in remotes.split()
 
 def doAction(args):
+    selection = selectArtifacts(args)
+    if not selection:
+        warning("0 artifacts selected")
+        return
+    if options.action:
+        log(options.action + " will be executed on the following artifacts:")
+    for arg in selection:
+        log(arg.name)
+    Journal.start(args, selection)
+    runActions(selection)
+    Journal.end()
+
+#Repeats last run recorded in journal (same selection, action, -u/-U) skipping phases which succeeded in it
+def resumeLastRun():
+    last = Journal.loadLast()
+    if not last:
+        fatal('Nothing to resume: journal %s has no runs' % Journal.getPath())
+        sys.exit(1)
+    options.action = options.action or last.get('action')
+    options.update = options.update or last.get('update')
+    options.rebase = options.rebase or last.get('rebase')
+    options.skipTests = options.skipTests or last.get('skipTests', False)
+    options.force = options.force or last.get('force', False)
+    options.online = options.online or last.get('online', False)
+    options.github_username = options.github_username or last.get('github_username')
+    if options.github_username and not isSafeRefName(options.github_username):
+        fatal('Invalid github username in journal: ' + options.github_username)
+        sys.exit(1)
+    selection = list()
+    for (path, remote, branch) in last['selection']:
+        artifact = Repository.resolveOne(path)
+        if branch:
+            artifact = artifact.withBranch(branch, remote)
+        selection.append(artifact)
+    print('Resuming run %s (%s %s): %d phases of %d artifacts are already done'
+          % (last['run'], last.get('action') or '', ' '.join(last.get('args') or []), len(Journal.completed), len(selection)))
+    Journal.start(last.get('args'), selection, last['run'])
+    runActions(selection)
+    Journal.end()
+
+#Resolves command line arguments (names, selectors and name#branch, name@remote#branch) to artifacts
+def selectArtifacts(args):
     selection = list()
     artifact_branch = "master"
     for arg in args:
@@ -144,44 +693,732 @@ def doAction(args):
                     artifact_branch = branch
             if not remote:
                 remote = options.github_username
-            target = Repository.resolveOne(artifactName)
-            target.remote = remote
-            target.branch = artifact_branch
+            target = Repository.resolveOne(artifactName).withBranch(artifact_branch, remote)
             warning('Using resolveOne() with custom remote and switch branch mode: %s@%s#%s' % (artifactName, target.remote, target.branch))
             selection.append(target)
 
-        if '#' in arg:
+        elif '#' in arg:
             (artifactName, branch) = str.split(arg, '#')
             if not branch:
                 branch = 'master'
             warning('Using resolveOne() with switch branch mode: %s#%s' % (artifactName, branch))
-            target = Repository.resolveOne(artifactName)
-            target.branch = branch
+            target = Repository.resolveOne(artifactName).withBranch(branch)
             selection.append(target)
         else:
             Repository.resolve(arg, selection)
-    if not selection:
-        warning("0 artifacts selected")
-        return
+    return removeDuplicates(selection)
+
+#Updates selected artifacts (-u/-U) and executes selected action on them
+def runActions(selection, readHeads=True):
+    run_order.clear()
+    for index, artifact in enumerate(selection):
+        run_order.setdefault(id(artifact), index)
+    if options.plan:
+        return showPlan(selection)
+    if options.workers:
+        return Coordinator(options.workers.split(',')).run(selection)
+
+    if options.update or options.rebase:
+        repos = [repo for repo in getWorkingCopies(selection) if not Journal.isCompleted(repo, 'update')]
+        if readHeads:
+            readRemoteHeads(repos)
+        runParallel(repos, gitCloneOrUpdate, getJobs(), phase='update')
+        showUpdateSummary()
     if options.action:
-        log(options.action + " will be executed on the following artifacts:")
-    for arg in selection:
-        log(arg.name)
+        prefetchBranchRemotes(selection)
+        return Repository.getAction(options.action).executeAll(selection)
+
+#Long running mode (--watch): manifest stays in memory, upstream HEADs of selected repositories are polled every
+#--interval seconds (polling of failing repositories backs off up to 1 hour), and only repositories whose HEAD
+#moved are queued for update and selected action. Queue holds each repository once and at most --queue-size of
+#them, the rest is picked up by next polls. Queue and last results are written to --status-file after each step
+class Watcher(object):
+    max_backoff = 3600
+
+    def __init__(self, selection):
+        self.selection = selection
+        self.repos = getWorkingCopies(selection)
+        self.queue = list()         #locations, oldest first
+        self.seen_heads = dict()    #location -> upstream HEAD which was processed
+        self.poll_failures = dict() #location -> number of failed polls in a row
+        self.next_poll = dict()     #location -> time of next poll
+        self.build_failures = dict() #location -> number of failed updates/actions of the same upstream HEAD in a row
+        self.next_retry = dict()    #location -> time when failed location is queued again
+        self.last_results = dict()  #artifact name -> {'time', 'result'}
+        self.last_poll = None
+        self.started = time.time()
+
+    def run(self):
+        log('Watching %d repositories, poll interval %d seconds' % (len(self.repos), options.interval))
+        while True:
+            self.poll()
+            self.writeStatus()
+            if self.queue:
+                self.process()
+                self.writeStatus()
+            self.endCycle()
+            RunLog.flush()
+            wake_up = min(list(self.next_poll.values()) + list(self.next_retry.values()) or [time.time() + options.interval])
+            while time.time() < wake_up:
+                time.sleep(min(1, max(wake_up - time.time(), 0)))
+
+    def poll(self):
+        now = time.time()
+        due = [repo for repo in self.repos if self.next_poll.get(repo.getLocationDir(), 0) <= now]
+        for repo in due:
+            remote_heads.pop(repo.getLocationDir(), None)
+        readRemoteHeads(due)
+        self.last_poll = now
+        for (location, retry) in list(self.next_retry.items()):
+            if retry <= now:
+                self.enqueue(location)
+        for repo in due:
+            location = repo.getLocationDir()
+            head = remote_heads.get(location)
+            if not isGitRepo(repo):
+                self.enqueue(location)
+            elif not head:
+                failures = self.poll_failures.get(location, 0) + 1
+                self.poll_failures[location] = failures
+                self.next_poll[location] = now + min(options.interval * 2 ** failures, max(Watcher.max_backoff, options.interval))
+                warning('%s: failed to read upstream HEAD (%d times in a row)' % (location, failures))
+                continue
+            elif location in self.seen_heads:
+                if self.seen_heads[location] != head:
+                    self.enqueue(location)
+            elif not runForArtifact(repo, lambda repo: changeDir(repo) or isUpToDateWithRemote(repo)):
+                self.enqueue(location)
+            else:
+                self.seen_heads[location] = head
+            self.poll_failures.pop(location, None)
+            self.next_poll[location] = now + options.interval
+
+    def enqueue(self, location):
+        if location in self.queue:
+            return
+        if len(self.queue) >= options.queue_size:
+            log('Queue is full, %s will be queued by next poll' % location)
+            return
+        self.queue.append(location)
+
+    def process(self):
+        locations = set(self.queue)
+        batch = [artifact for artifact in self.selection if artifact.getLocationDir() in locations]
+        if isinstance(Repository.getAction(options.action), MavenGoal):
+            batch = BuildGraph(self.selection).getWithDependents(batch) #dependents are skipped if their inputs didn't change
+        heads = dict((location, remote_heads.get(location)) for location in locations)
+        log('Processing %d changed repositories: %s' % (len(locations), ', '.join(self.queue)))
+        results = runActions(batch, readHeads=False)
+        for (index, artifact) in enumerate(batch):
+            result = 'done'
+            if results is not None and results[index] is not True:
+                result = {False: 'failed', None: 'skipped'}.get(results[index], str(results[index]))
+            self.last_results[artifact.name] = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'result': result}
+        #HEAD is processed only if all artifacts of repository succeeded, failed ones are retried with backoff
+        failed = set(artifact.getLocationDir() for (index, artifact) in enumerate(batch)
+                     if results is not None and results[index] is not True)
+        now = time.time()
+        for location in locations:
+            if location in failed:
+                failures = self.build_failures.get(location, 0) + 1
+                self.build_failures[location] = failures
+                self.next_retry[location] = now + min(options.interval * 2 ** (failures - 1), max(Watcher.max_backoff, options.interval))
+            else:
+                self.build_failures.pop(location, None)
+                self.next_retry.pop(location, None)
+                if heads[location]:
+                    self.seen_heads[location] = heads[location]
+        self.queue = [location for location in self.queue if location not in locations]
+
+    #Prints and forgets messages of finished cycle, so memory doesn't grow in long running process
+    def endCycle(self):
+        showWarnings()
+        showFailures()
+        del warnings[:]
+        del failures[:]
+        del executed_commands[:]
+        del command_timings[:]
+        del BuildState.skipped[:]
+        fetched_in_run.clear()
+
+    def writeStatus(self):
+        import json
+        status = {'pid': os.getpid(), 'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                  'last_poll': self.last_poll and time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.last_poll)),
+                  'queue_depth': len(self.queue), 'queue': list(self.queue), 'repositories': len(self.repos),
+                  'poll_failures': self.poll_failures, 'build_failures': self.build_failures, 'last_results': self.last_results}
+        path = options.status_file or os.path.join(home_dir, '.mvnrepo-updater.status.json')
+        writeFileAtomically(path, json.dumps(status, indent=1, sort_keys=True))
+
+#Branch, remote and user names end up in git commands: only letters, digits and . _ / - are allowed
+def isSafeRefName(name):
+    import re
+    return isinstance(name, (str, type(u''))) and bool(re.match(r'^[A-Za-z0-9_][A-Za-z0-9._/-]*$', name)) and '..' not in name
+
+#Shared secret of distributed mode (--secret-file), None if it is not set
+def readSecret():
+    if not options.secret_file:
+        return None
+    with open(options.secret_file, 'rb') as secret_file:
+        secret = secret_file.read().strip()
+    if not secret:
+        fatal('Secret file %s is empty' % options.secret_file)
+        sys.exit(1)
+    return secret
+
+#Proof of secret sent by coordinator: HMAC of random nonce from hello message of worker
+def signNonce(secret, nonce):
+    import hmac
+    import hashlib
+    return hmac.new(secret, nonce.encode('ascii'), hashlib.sha256).hexdigest()
+
+#Distributed mode protocol: JSON object per line over TCP. Worker (--serve) greets coordinator (--workers) with
+#{'type': 'hello', 'host', 'slots', 'nonce'}, receives {'type': 'options', 'auth'} (forwarded options of coordinator
+#command line and signNonce() of --secret-file, worker closes connection if it doesn't match its own secret) and
+#{'type': 'job', 'id', 'kind', 'action', 'artifact', 'branch', 'remote', 'upstream'} messages, and answers with
+#{'type': 'log', 'id', 'line'} output lines and one {'type': 'result', 'id', 'result', ...} per job. Worker sends
+#{'type': 'ping'} every few seconds, so coordinator can tell a busy worker from a lost one
+def sendMessage(connection, lock, message):
+    import json
+    with lock:
+        connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+def readMessages(reader):
+    import json
+    while True:
+        line = reader.readline()
+        if not line:
+            return
+        if line.strip():
+            yield json.loads(line.decode('utf-8'))
+
+def parseAddress(address, defaultHost):
+    if ':' in address:
+        (host, port) = address.rsplit(':', 1)
+        return (host or defaultHost, int(port))
+    return (defaultHost, int(address))
+
+#Worker of distributed mode (--serve [HOST:]PORT): runs jobs of one coordinator at a time, up to --jobs at once,
+#in its own apps home with the same update and build logic as local runs
+class Worker(object):
+    forwarded_options = {'update': bool, 'rebase': bool, 'resetGitRepos': bool, 'skipTests': bool, 'force': bool,
+                         'online': bool, 'github_username': str} #values of other types are ignored
+    heartbeat = 5
+
+    #Jobs run git and maven commands: worker reachable from other hosts must check secret of coordinator
+    def __init__(self, address):
+        self.address = parseAddress(address, 'localhost')
+        self.secret = readSecret()
+        if not self.secret and not (self.address[0] in ('localhost', '::1') or self.address[0].startswith('127.')):
+            fatal('Worker listening on %s needs --secret-file shared with coordinators' % self.address[0])
+            sys.exit(1)
 
-    for artifact in selection:
-        if options.update or options.rebase:
+    def serve(self):
+        import socket
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(self.address)
+        server.listen(5)
+        print('Worker is listening on %s:%d, apps home: %s' % (self.address[0], server.getsockname()[1], home_dir))
+        sys.stdout.flush()
+        while True:
+            (connection, address) = server.accept()
+            log2file('Coordinator %s:%d connected' % address)
+            self.session(connection)
+            log2file('Coordinator %s:%d disconnected' % address)
+            RunLog.flush()
+
+    #Serves coordinator until it disconnects. Jobs which are still running are finished before next coordinator
+    #is accepted, so builds of two coordinators never share working copies
+    def session(self, connection):
+        import socket
+        lock = threading.Lock()
+        alive = [True]
+        def send(message):
+            try:
+                sendMessage(connection, lock, message)
+            except (IOError, OSError, socket.error):
+                alive[0] = False
+        def heartbeat():
+            while alive[0]:
+                time.sleep(Worker.heartbeat)
+                send({'type': 'ping'})
+        import binascii
+        nonce = binascii.hexlify(os.urandom(16)).decode('ascii')
+        send({'type': 'hello', 'host': socket.gethostname(), 'slots': getJobs(), 'version': version, 'nonce': nonce})
+        pinger = threading.Thread(target=heartbeat)
+        pinger.daemon = True
+        pinger.start()
+        jobs = list()
+        try:
+            authorized = False
+            for message in readMessages(connection.makefile('rb')):
+                if not authorized:
+                    if message.get('type') != 'options' or not self.isAuthorized(message.get('auth'), nonce):
+                        log2file('Coordinator is not authorized, connection closed')
+                        break
+                    authorized = True
+                if message['type'] == 'options':
+                    for (name, value) in (message.get('options') or dict()).items():
+                        if Worker.isValidOption(name, value):
+                            setattr(options, name, value)
+                elif message['type'] == 'job':
+                    job = threading.Thread(target=self.runJob, args=(message, send))
+                    job.daemon = True
+                    job.start()
+                    jobs.append(job)
+        except (IOError, OSError, ValueError, socket.error):
+            log2file('Connection to coordinator failed: ' + str(sys.exc_info()[1]))
+        alive[0] = False
+        for job in jobs:
+            job.join()
+        connection.close()
+
+    def isAuthorized(self, auth, nonce):
+        if not self.secret:
+            return True
+        import hmac
+        expected = signNonce(self.secret, nonce)
+        if not isinstance(auth, (str, type(u''))):
+            return False
+        if hasattr(hmac, 'compare_digest'):
+            return hmac.compare_digest(str(auth), expected)
+        return auth == expected
+
+    @staticmethod
+    def isValidOption(name, value):
+        if Worker.forwarded_options.get(name) is bool:
+            return isinstance(value, bool)
+        return name in Worker.forwarded_options and (value is None or isSafeRefName(value))
+
+    #Job fields end up in git and maven commands, job with anything unexpected in them is rejected
+    @staticmethod
+    def isValidJob(job):
+        upstream = job.get('upstream') or []
+        return (job.get('kind') in ('describe', 'run') and isSafeRefName(job.get('artifact'))
+                and (job.get('action') is None or job.get('action') in Repository.action_map)
+                and not [name for name in (job.get('branch'), job.get('remote')) if name is not None and not isSafeRefName(name)]
+                and isinstance(upstream, list)
+                and not [entry for entry in upstream if not (isinstance(entry, list) and len(entry) == 2 and isSafeRefName(entry[0])
+                                                             and (entry[1] is None or isSafeRefName(entry[1])))])
+
+    def runJob(self, job, send):
+        context.sink = lambda line: send({'type': 'log', 'id': job['id'], 'line': line})
+        try:
+            if not Worker.isValidJob(job):
+                send({'type': 'result', 'id': job['id'], 'result': False, 'warnings': ['Invalid job for ' + str(job.get('artifact'))]})
+                return
+            try:
+                artifact = Repository.resolveOne(job['artifact'])
+                if job.get('branch'):
+                    artifact = artifact.withBranch(job['branch'], job.get('remote'))
+            except (Exception, SystemExit):
+                send({'type': 'result', 'id': job['id'], 'result': False, 'warnings': ['Unknown artifact: ' + job['artifact']]})
+                return
+            reply = runForArtifact(artifact, lambda artifact: self.execute(job, artifact), phase=job['kind']) or {'result': False}
+            with output_lock:
+                reply['warnings'] = [mesg for (owner, mesg) in warnings if owner is artifact]
+                reply['failures'] = [failure for (owner, failure) in failures if owner is artifact]
+                warnings[:] = [record for record in warnings if record[0] is not artifact]
+                failures[:] = [record for record in failures if record[0] is not artifact]
+            reply.update({'type': 'result', 'id': job['id']})
+            send(reply)
+        finally:
+            context.sink = None
+
+    #'describe' job updates (or clones) working copy and reports keys of its pom.xml for BuildGraph of coordinator,
+    #'run' job updates working copy if -u/-U is set and runs action (maven goal with inputs of upstream artifacts)
+    def execute(self, job, artifact):
+        action = job.get('action') and Repository.getAction(job['action'])
+        changeDir(artifact)
+        if options.update or options.rebase or (isinstance(action, MavenGoal) and action.gitUpdate):
+            readRemoteHeads([artifact])
+            gitCloneOrUpdate(artifact)
+        elif not isGitRepo(artifact) and (job['kind'] == 'describe' or isinstance(action, MavenGoal)):
             gitCloneOrUpdate(artifact)
-        if options.action:
-            Repository.applyAction(options.action, artifact)
+        if job['kind'] == 'describe':
+            pom = readPom(artifact)
+            return {'result': isGitRepo(artifact) or options.echoMode,
+                    'produced': sorted(pom.getProducedKeys()), 'required': sorted(pom.getRequiredKeys())}
+        if isinstance(action, MavenGoal):
+            upstream = list()
+            for (path, inputs) in job.get('upstream') or []:
+                dependency = Repository.resolveOne(path).withBranch(None)
+                BuildState.inputs[id(dependency)] = inputs
+                upstream.append(dependency)
+            return {'result': action.build(artifact, upstream), 'inputs': BuildState.inputs.get(id(artifact))}
+        if action:
+            return {'result': action.execute(artifact)}
+        return {'result': isGitRepo(artifact) or options.echoMode}
+
+#Keys of pom.xml reported by worker, used by BuildGraph of coordinator instead of Pom
+class RemotePom(object):
+    def __init__(self, message):
+        self.produced = set(message and message.get('produced') or [])
+        self.required = set(message and message.get('required') or [])
+
+    def getProducedKeys(self):
+        return self.produced
+
+    def getRequiredKeys(self):
+        return self.required
+
+#Coordinator side of connection to worker. Reader thread prints output lines of jobs and hands results over to
+#threads waiting for them. Worker is lost when connection breaks or it is silent for --worker-timeout seconds
+class WorkerConnection(object):
+    def __init__(self, address):
+        import socket
+        self.address = address
+        self.socket = socket.create_connection(parseAddress(address, 'localhost'), options.worker_timeout)
+        self.reader = self.socket.makefile('rb')
+        hello = next(readMessages(self.reader), None)
+        if not hello or hello.get('type') != 'hello':
+            raise IOError('%s is not mvnrepo-updater worker' % address)
+        self.socket.settimeout(None)
+        self.name = '%s(%s)' % (hello.get('host'), address)
+        self.slots = max(1, hello.get('slots') or 1)
+        self.lock = threading.Lock()
+        self.jobs = dict() #job id -> [artifact, threading.Event, result message]
+        self.alive = True
+        self.lastSeen = time.time()
+        secret = readSecret()
+        self.send({'type': 'options', 'options': dict((name, getattr(options, name)) for name in Worker.forwarded_options),
+                   'auth': secret and signNonce(secret, hello.get('nonce') or '')})
+        reader = threading.Thread(target=self.readLoop)
+        reader.daemon = True
+        reader.start()
+
+    def send(self, message):
+        import socket
+        try:
+            sendMessage(self.socket, self.lock, message)
+        except (IOError, OSError, socket.error):
+            self.lose(str(sys.exc_info()[1]))
+
+    def readLoop(self):
+        try:
+            for message in readMessages(self.reader):
+                self.lastSeen = time.time()
+                job = self.jobs.get(message.get('id'))
+                if job and message['type'] == 'log':
+                    with output_lock:
+                        sys.stdout.write('[%s@%s %s] %s\n' % (job[0].name, self.address, time.strftime('%H:%M:%S'), message['line']))
+                        sys.stdout.flush()
+                        log2file('[%s] OUT: %s' % (self.address, message['line']), job[0])
+                elif job and message['type'] == 'result':
+                    job[2] = message
+                    job[1].set()
+            self.lose('connection closed')
+        except Exception:
+            self.lose(str(sys.exc_info()[1]))
+
+    def lose(self, reason):
+        with self.lock:
+            if not self.alive:
+                return
+            self.alive = False
+        log2file('Worker %s lost: %s' % (self.name, reason))
+        try:
+            self.socket.close()
+        except Exception:
+            pass
+        for job in list(self.jobs.values()):
+            job[1].set()
+
+    #Sends job and waits for its result message, returns None if worker was lost meanwhile
+    def call(self, job, artifact):
+        entry = [artifact, threading.Event(), None]
+        self.jobs[job['id']] = entry
+        try:
+            if not self.alive: #lost after acquire(), lose() didn't see this job
+                return None
+            self.send(job)
+            while not entry[1].wait(1):
+                if not self.alive:
+                    return None
+                if time.time() - self.lastSeen > options.worker_timeout:
+                    self.lose('no messages for %d seconds' % options.worker_timeout)
+            return entry[2]
+        finally:
+            del self.jobs[job['id']]
+
+    def close(self):
+        with self.lock:
+            self.alive = False
+        self.socket.close()
+
+#Coordinator of distributed mode (--workers HOST:PORT,HOST:PORT): selection is resolved locally, every artifact is
+#a job run by a free worker slot. Maven goals are scheduled by BuildGraph built from pom keys reported by workers.
+#Job of lost worker is retried on another one (--retries times), results and per worker counts are printed at the end
+class Coordinator(object):
+    def __init__(self, addresses):
+        try:
+            import queue
+        except ImportError: #python 2
+            import Queue as queue
+        self.connections = list()
+        for address in addresses:
+            try:
+                self.connections.append(WorkerConnection(address.strip()))
+            except Exception:
+                warning('Worker %s is not available: %s' % (address, str(sys.exc_info()[1])))
+        if not self.connections:
+            fatal('No workers available: ' + ', '.join(addresses))
+            sys.exit(1)
+        self.idle = queue.Queue()
+        for connection in self.connections:
+            for slot in range(connection.slots):
+                self.idle.put(connection)
+        self.empty = queue.Empty
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.counts = dict((connection.name, {'done': 0, 'failed': 0, 'lost': 0}) for connection in self.connections)
+
+    def run(self, selection):
+        action = options.action and Repository.getAction(options.action)
+        jobs = sum(connection.slots for connection in self.connections)
+        try:
+            if isinstance(action, MavenGoal):
+                described = runParallel(selection, lambda artifact: self.dispatch('describe', artifact), jobs, phase='describe')
+                failed = [index for (index, message) in enumerate(described) if not (message and message.get('result'))]
+                graph = BuildGraph(selection, [RemotePom(message) for message in described])
+                graph.setEstimates(BuildHistory.getEstimates(selection, action.name))
+                done = [index for (index, artifact) in enumerate(selection) if Journal.isCompleted(artifact, action.name)]
+                inputs = dict()
+                def build(artifact):
+                    upstream = [[dependency.getPath(), inputs.get(id(dependency))] for dependency in graph.getUpstream(artifact)]
+                    start = time.time()
+                    message = self.dispatch('run', artifact, upstream)
+                    if message:
+                        inputs[id(artifact)] = message.get('inputs')
+                        if message.get('result'):
+                            BuildHistory.record(artifact, action.name, time.time() - start)
+                    Journal.record(artifact, action.name, message and message.get('result'))
+                    return message and message.get('result')
+                results = graph.run(build, jobs, failed, phase=action.name, done=done)
+            else:
+                phase = options.action or 'update'
+                def execute(artifact):
+                    if Journal.isCompleted(artifact, phase):
+                        return True
+                    result = (self.dispatch('run', artifact) or {}).get('result')
+                    Journal.record(artifact, phase, result)
+                    return result
+                results = runParallel(selection, execute, jobs, phase=phase)
+        finally:
+            for connection in self.connections:
+                connection.close()
+        self.showSummary(results)
+        return results
+
+    #Runs job on free worker slot, retrying it on another worker if worker is lost. Returns result message or None
+    def dispatch(self, kind, artifact, upstream=None):
+        for attempt in range(options.retries + 1):
+            connection = self.acquire()
+            if connection is None:
+                break
+            with self.lock:
+                self.last_id += 1
+                job = {'type': 'job', 'id': self.last_id, 'kind': kind, 'action': options.action, 'upstream': upstream,
+                       'artifact': artifact.getPath(), 'branch': artifact.branch, 'remote': artifact.remote}
+            message = connection.call(job, artifact)
+            if message is None:
+                with self.lock:
+                    self.counts[connection.name]['lost'] += 1
+                warning('%s: worker %s was lost, attempt %d of %d' % (artifact.name, connection.name, attempt + 1, options.retries + 1))
+                continue
+            self.idle.put(connection)
+            for mesg in message.get('warnings') or []:
+                warning('[%s] %s' % (connection.address, mesg))
+            with output_lock:
+                for failure in message.get('failures') or []:
+                    failures.append((artifact, tuple(failure)))
+            if kind == 'run':
+                with self.lock:
+                    self.counts[connection.name][message.get('result') and 'done' or 'failed'] += 1
+            return message
+        fatal('%s: no worker could run %s job' % (artifact.name, kind))
+        return None
+
+    #Free slot of worker which is still alive, None if all workers are lost
+    def acquire(self):
+        while [connection for connection in self.connections if connection.alive]:
+            try:
+                connection = self.idle.get(timeout=1)
+            except self.empty:
+                continue
+            if connection.alive:
+                return connection
+        return None
+
+    def showSummary(self, results):
+        for connection in self.connections:
+            counts = self.counts[connection.name]
+            print('Worker %s: %d done, %d failed%s' % (connection.name, counts['done'], counts['failed'],
+                  counts['lost'] and ', lost with %d jobs' % counts['lost'] or ''))
+        print('Artifacts: %d done, %d failed, %d skipped' % (len([result for result in results if result]),
+              len([result for result in results if result is False]), len([result for result in results if result is None])))
+
+#Append-only journal of runs in APPS_DIR/.mvnrepo-updater.journal, JSON object per line: start of run (arguments,
+#action and selection), result of each phase of artifact (update, switch, action) and end of run. Each line is
+#written by one os.write() to file opened in append mode, so lines of parallel threads and processes never mix.
+#Resumed run (--resume) writes to journal with id of the run it resumes, so it can be resumed again
+class Journal(object):
+    filename = '.mvnrepo-updater.journal'
+    run = None          #id of current run, nothing is recorded outside of runs
+    completed = set()   #(artifact key, phase) which succeeded in resumed run
+    lock = threading.Lock()
+
+    @staticmethod
+    def getPath():
+        return os.path.join(home_dir, Journal.filename)
+
+    @staticmethod
+    def getKey(artifact):
+        return '%s@%s#%s' % (artifact.getPath(), artifact.remote, artifact.branch or '')
+
+    @staticmethod
+    def write(record):
+        import json
+        record['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        with Journal.lock:
+            journal = os.open(Journal.getPath(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, int('644', 8))
+            try:
+                os.write(journal, line)
+            finally:
+                os.close(journal)
+
+    @staticmethod
+    def start(args, selection, run=None):
+        if options.echoMode or options.plan:
+            return
+        Journal.run = run or '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        Journal.write({'event': 'start', 'run': Journal.run, 'args': list(args or []), 'action': options.action,
+                       'update': options.update, 'rebase': options.rebase, 'resumed': bool(run),
+                       'skipTests': options.skipTests, 'force': options.force, 'online': options.online,
+                       'github_username': options.github_username,
+                       'selection': [[artifact.getPath(), artifact.remote, artifact.branch] for artifact in selection]})
+
+    @staticmethod
+    def end():
+        if Journal.run:
+            Journal.write({'event': 'end', 'run': Journal.run, 'failures': len(failures)})
+
+    #Records result of phase: True - ok, False - failed, None - skipped
+    @staticmethod
+    def record(artifact, phase, result):
+        if Journal.run:
+            Journal.write({'event': 'phase', 'run': Journal.run, 'artifact': Journal.getKey(artifact), 'phase': phase,
+                           'result': {True: 'ok', False: 'failed', None: 'skipped'}.get(result, result and 'ok' or 'failed')})
+
+    @staticmethod
+    def isCompleted(artifact, phase):
+        return (Journal.getKey(artifact), phase) in Journal.completed
+
+    #Start record of last run; phases which succeeded in it (and in its resumed runs) are put to completed
+    @staticmethod
+    def loadLast():
+        import json
+        records = list()
+        try:
+            with open(Journal.getPath(), 'rb') as journal:
+                for line in journal:
+                    try:
+                        records.append(json.loads(line.decode('utf-8')))
+                    except ValueError: #line of interrupted write
+                        continue
+        except (IOError, OSError):
+            return None
+        starts = [record for record in records if record.get('event') == 'start']
+        if not starts:
+            return None
+        last = [record for record in starts if record['run'] == starts[-1]['run']][0]
+        for record in records:
+            if record.get('run') == last['run'] and record.get('event') == 'phase':
+                key = (record['artifact'], record['phase'])
+                if record['result'] == 'ok':
+                    Journal.completed.add(key)
+                else:
+                    Journal.completed.discard(key)
+        return last
+
+#Same repository selected by several arguments (with same remote and branch) is processed once
+def removeDuplicates(selection):
+    unique = list()
+    keys = set()
+    for artifact in selection:
+        key = (artifact.getLocationDir(), artifact.remote, artifact.branch)
+        if key not in keys:
+            keys.add(key)
+            unique.append(artifact)
+    return unique
+
+#First artifact of each working copy: same repository may be selected several times with different branches
+def getWorkingCopies(selection):
+    locations = set()
+    repos = list()
+    for artifact in selection:
+        if artifact.getLocationDir() not in locations:
+            locations.add(artifact.getLocationDir())
+            repos.append(artifact)
+    return repos
+
+#Calls callback(artifact) with per-thread context set. Failures are reported and None is returned
+def runForArtifact(artifact, callback, phase=None):
+    context.artifact = artifact
+    context.cwd = None
+    context.phase = phase
+    start = time.time()
+    result = None
+    try:
+        result = callback(artifact)
+        return result
+    except (Exception, SystemExit):
+        fatal('%s failed: %s' % (artifact.name, str(sys.exc_info()[1])))
+    finally:
+        if phase:
+            recordTiming('phase', phase, start, result)
+        context.artifact = None
+        context.cwd = None
+        context.phase = None
+
+#Runs loop() in 'count' threads (or directly in current thread if count <= 1) and waits for all of them
+def runWorkers(count, loop):
+    if count <= 1:
+        loop()
+        return
+    threads = [threading.Thread(target=loop) for i in range(count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+#Number of worker threads set by --jobs, or 'default' if option is not set
+def getJobs(default=1):
+    if options and options.jobs:
+        return max(options.jobs, 1)
+    return default
+
+#Runs callback(artifact) for every artifact using up to 'jobs' worker threads. Returns results in selection order
+def runParallel(selection, callback, jobs=1, phase=None):
+    results = [None] * len(selection)
+    tasks = list(reversed(range(len(selection))))
+    lock = threading.Lock()
+    def worker():
+        while True:
+            with lock:
+                if not tasks:
+                    return
+                index = tasks.pop()
+            results[index] = runForArtifact(selection[index], callback, phase)
+    runWorkers(min(jobs or 1, len(selection)), worker)
+    return results
 
 #Maven Artifact
 class Artifact(object):
-    baseUrl = None
-    organisation = None
-    name = None
-    customHomeDir = None
-    remote = 'upstream'
-    branch = None
+    __slots__ = ('baseUrl', 'organisation', 'name', 'customHomeDir', 'remote', 'branch', 'cloneOptions')
 
     #url format: 'git://#baseUrl#/#organisation#/#name#.git'
     def __init__(self, scmUrl, path=None):
@@ -189,11 +1426,44 @@ class Artifact(object):
         self.baseUrl = baseUrl
         self.organisation = organisation
         self.name = name
+        self.customHomeDir = None
+        self.remote = 'upstream'
+        self.branch = None
+        self.cloneOptions = None #options of artifacts.txt line, see parseCloneOptions()
         self.setAbsoluteLocationDir(path)
 
+    #Creates artifact from record of compiled manifest cache, without parsing url
+    @staticmethod
+    def fromRecord(record):
+        artifact = Artifact.__new__(Artifact)
+        (artifact.baseUrl, artifact.organisation, artifact.name, artifact.cloneOptions) = record
+        artifact.customHomeDir = None
+        artifact.remote = 'upstream'
+        artifact.branch = None
+        return artifact
+
+    def toRecord(self):
+        return (self.baseUrl, self.organisation, self.name, self.cloneOptions)
+
     def __str__(self):
         return 'Artifact: ' + self.getScmUrl()
 
+    def getPath(self):
+        return self.organisation + '/' + self.name
+
+    #Copy of this artifact which switches to 'branch' of 'remote' (shared manifest entry stays unchanged)
+    def withBranch(self, branch, remote=None):
+        import copy
+        for name in (branch, remote):
+            if name and not isSafeRefName(name):
+                fatal('Invalid branch or remote name: ' + name)
+                sys.exit(1)
+        target = copy.copy(self)
+        target.branch = branch
+        if remote:
+            target.remote = remote
+        return target
+
     def getLocationDir(self):
         if self.customHomeDir:
             return self.customHomeDir
@@ -271,13 +1541,29 @@ class Action(object):
     changedir = False
     silentMode = False
     printName = False
+    parallel = False
 
-    def __init__(self, name, callback, silentMode=False, changedir=True, printName=False):
+    def __init__(self, name, callback, silentMode=False, changedir=True, printName=False, parallel=False):
         self.name = name
         self.callback = callback
         self.changedir = changedir
         self.silentMode = silentMode
         self.printName = printName
+        self.parallel = parallel
+
+    #Executes action on all selected artifacts one by one in selection order, or on --jobs artifacts at once if parallel is set.
+    #Artifacts on which action succeeded in resumed run (--resume) are skipped
+    def executeAll(self, selection):
+        jobs = 1
+        if self.parallel:
+            jobs = getJobs()
+        def execute(artifact):
+            if Journal.isCompleted(artifact, self.name):
+                return True
+            result = self.execute(artifact)
+            Journal.record(artifact, self.name, result)
+            return result
+        return runParallel(selection, execute, jobs, phase=self.name)
 
     def execute(self, artifact):
         if self.callback:
@@ -289,53 +1575,917 @@ class Action(object):
                 print(artifact.name)
             if switchBranch(artifact):
                 self.callback(artifact)
+                return True
             else:
                 fatal('Action skipped for ' + artifact.name + ' failed to switch branch!')
         else:
             print('Action callback function is not set')
+        return False
 
 class MavenGoal(Action):
     maven_command = None
     gitUpdate = None
+    incremental = False
 
-    def __init__(self, name, command, gitUpdate=False):
+    def __init__(self, name, command, gitUpdate=False, incremental=False):
         self.name = name
         self.maven_command = command
         self.gitUpdate = gitUpdate
+        self.incremental = incremental
+
+    #Clones/updates all artifacts in parallel, then switches branches and runs maven in dependency order (read
+    #from pom.xml files). Up to options.jobs builds run at once; a failed build skips only artifacts which depend on it
+    def executeAll(self, selection):
+        repos = getWorkingCopies(selection)
+        if self.gitUpdate:
+            readRemoteHeads(repos)
+        prepared = runParallel(repos, self.prepare, getJobs(), phase='prepare')
+        showUpdateSummary()
+        prepared = dict((repo.getLocationDir(), result) for (repo, result) in zip(repos, prepared))
+        graph = BuildGraph(selection)
+        graph.setEstimates(BuildHistory.getEstimates(selection, self.name))
+        failed = [index for (index, artifact) in enumerate(selection) if not prepared[artifact.getLocationDir()]]
+        done = [index for (index, artifact) in enumerate(selection) if Journal.isCompleted(artifact, self.name)]
+        for index in done:
+            BuildState.restoreInputs(selection[index], self.name)
+        if options.pre_resolve:
+            DependencyResolution.resolve([(artifact, pom) for (index, (artifact, pom))
+                                          in enumerate(zip(selection, graph.poms)) if index not in failed])
+        results = graph.run(lambda artifact: self.build(artifact, graph.getUpstream(artifact)), getJobs(), failed, phase=self.name, done=done)
+        if BuildState.skipped:
+            warning('%d artifacts are up to date, mvn %s skipped (use --force to rebuild): %s'
+                    % (len(BuildState.skipped), self.maven_command, ', '.join(sorted(BuildState.skipped))))
+        return results
 
     def execute(self, artifact):
+        if self.prepare(artifact):
+            return self.build(artifact)
+        return False
+
+    def prepare(self, artifact):
         changeDir(artifact)
-        if not isGitRepo(artifact) or self.gitUpdate:
+        if not isGitRepo(artifact) or (self.gitUpdate and not Journal.isCompleted(artifact, 'update')):
             gitCloneOrUpdate(artifact)
-        if switchBranch(artifact):
+        return isGitRepo(artifact) or options.echoMode
+
+    #Switches branch and runs maven goal, or skips it if incremental goal inputs (commit, working tree, flags and
+    #inputs of upstream artifacts) are the same as on last successful build
+    def build(self, artifact, upstream=()):
+        changeDir(artifact)
+        if not switchBranch(artifact):
             #TODO if self.gitUpdate: run git pull??
-            maven(self.maven_command)
-        else:
             fatal('Action skipped for ' + artifact.name + ' failed to switch branch!')
+            return False
+        inputs = None
+        if self.incremental and not options.echoMode:
+            inputs = BuildState.getInputs(artifact, self.maven_command, upstream, self.name)
+            if not options.force and BuildState.isUpToDate(artifact, self.name, inputs):
+                log('%s is up to date, mvn %s skipped' % (artifact.name, self.maven_command))
+                BuildState.skipped.append(artifact.name)
+                Journal.record(artifact, self.name, True)
+                return True
+        share = None
+        if ResourceBudget.isEnabled():
+            pom = readPom(artifact)
+            share = ResourceBudget.acquire(artifact, pom.modules and len(pom.getAllPoms()) - 1 or 1) #aggregator isn't a module
+        try:
+            start = time.time()
+            command = self.maven_command + self.getOfflineFlag(artifact)
+            code = maven(command, share)
+            if code and command != self.maven_command and popOfflineFailure(artifact):
+                warning('%s: offline build needs artifacts missing in local repository, mvn %s is run online'
+                        % (artifact.name, self.maven_command))
+                code = maven(self.maven_command, share)
+        finally:
+            if share:
+                ResourceBudget.release(share)
+        Journal.record(artifact, self.name, not code)
+        if code:
+            fatal('%s: mvn %s failed' % (artifact.name, self.maven_command))
+            return False
+        if inputs:
+            BuildState.record(artifact, self.name, inputs)
+        BuildHistory.record(artifact, self.name, time.time() - start)
+        return True
+
+    #' -o' if dependencies of artifact were resolved by DependencyResolution and its pom.xml files didn't change
+    #since then. Deploy needs network, so deploy goals only skip checking remote repositories for snapshot updates
+    def getOfflineFlag(self, artifact):
+        if options.online or options.echoMode or '-o' in self.maven_command.split():
+            return ''
+        if not DependencyResolution.isResolved(artifact):
+            return ''
+        if 'deploy' in self.maven_command.split():
+            return ' -nsu'
+        return ' -o'
+
+#Machine-wide budget of cores and memory shared by concurrent maven builds (--budget). Multi-module reactor asks for
+#a thread per module (-T), single module build for one thread; heap (-Xmx) of build is its part of memory budget in
+#proportion to its threads. Build waits until a core and minimal heap are free and leaves a core for each build which
+#is still waiting, so shares released by finished builds go to queued builds instead of the first of them taking all
+class ResourceBudget(object):
+    min_heap = 256
+    condition = threading.Condition()
+    cores = None
+    memory = None #MB, None if it's unknown: heap is not set
+    free_cores = 0
+    free_memory = 0
+    waiting = 0
+
+    @staticmethod
+    def isEnabled():
+        return bool(options.budget or options.budget_cpus or options.budget_memory)
+
+    #--budget-cpus or cores available to this process
+    @staticmethod
+    def detectCores():
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+    #--budget-memory or 60% of physical memory (the rest is left for JVM overhead, OS and other processes)
+    @staticmethod
+    def detectMemory():
+        try:
+            return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.6 / 1024 / 1024)
+        except (AttributeError, ValueError, OSError):
+            return None
+
+    #Waits for free share of budget and takes it: returns (threads, heap MB or None)
+    @staticmethod
+    def acquire(artifact, modules):
+        budget = ResourceBudget
+        with budget.condition:
+            if budget.cores is None:
+                budget.cores = max(1, options.budget_cpus or budget.detectCores())
+                budget.memory = options.budget_memory or budget.detectMemory()
+                budget.free_cores = budget.cores
+                budget.free_memory = budget.memory or 0
+            budget.waiting += 1
+            try:
+                while budget.free_cores < 1 or (budget.memory and budget.free_memory < min(budget.min_heap, budget.memory)):
+                    budget.condition.wait()
+            finally:
+                budget.waiting -= 1
+            threads = max(1, min(modules, budget.free_cores - budget.waiting))
+            heap = None
+            if budget.memory:
+                heap = min(budget.free_memory, max(budget.min_heap, budget.memory * threads // budget.cores))
+                budget.free_memory -= heap
+            budget.free_cores -= threads
+        log('%s: %d of %d modules built in parallel, heap %s MB (free: %d cores, %s MB)'
+            % (artifact.name, threads, modules, heap or '-', budget.free_cores, budget.memory and str(budget.free_memory) or '-'))
+        return (threads, heap)
+
+    @staticmethod
+    def release(share):
+        with ResourceBudget.condition:
+            ResourceBudget.free_cores += share[0]
+            if share[1]:
+                ResourceBudget.free_memory += share[1]
+            ResourceBudget.condition.notify_all()
+
+#Removes last failure of artifact from failures if maven failed because it can't download artifacts in offline mode
+def popOfflineFailure(artifact):
+    with output_lock:
+        for record in reversed(failures):
+            if record[0] is artifact:
+                if [line for line in record[1][2] if 'in offline mode' in line]:
+                    failures.remove(record)
+                    return True
+                return False
+    return False
+
+#Resolves dependencies, plugins and parent poms of selected artifacts in one pass (-x, or before maven goals with
+#--pre-resolve). Distinct coordinates are spread over synthetic poms in APPS_DIR/.mvnrepo-updater-resolve which
+#are resolved in parallel (--jobs, 4 by default), one mvn per pom. Versions of the same groupId:artifactId never share
+#a pom, maven would resolve only one of them. Artifacts whose coordinates were all resolved are recorded in build
+#state, their maven goals run offline until their pom.xml files change (see MavenGoal.getOfflineFlag())
+class DependencyResolution(Action):
+    goal = 'resolve'
+    dirname = '.mvnrepo-updater-resolve'
+
+    def __init__(self):
+        Action.__init__(self, 'resolve', None)
+
+    #Clones missing working copies and switches branches, then resolves requirements of their pom.xml files
+    def executeAll(self, selection):
+        targets = dict()
+        for artifact in selection:
+            targets.setdefault(artifact.getLocationDir(), list()).append(artifact)
+        def readPoms(repo):
+            changeDir(repo)
+            if not isGitRepo(repo):
+                gitCloneOrUpdate(repo)
+            poms = list()
+            for artifact in targets[repo.getLocationDir()]:
+                changeDir(artifact)
+                if switchBranch(artifact):
+                    poms.append((artifact, readPom(artifact)))
+            return poms
+        results = runParallel(getWorkingCopies(selection), readPoms, getJobs(), phase='prepare')
+        return DependencyResolution.resolve([target for result in results if result for target in result], selection)
+
+    def execute(self, artifact):
+        return self.executeAll([artifact])
+
+    #Resolves coordinates required by (artifact, pom) targets. Returns True/False (all coordinates of artifact
+    #were resolved) for each artifact of selection
+    @staticmethod
+    def resolve(targets, selection=None):
+        produced = set()
+        for (artifact, pom) in targets:
+            produced.update(pom.getProducedKeys())
+        required = dict() #coordinate -> ids of artifacts which need it
+        unknown = set()   #ids of artifacts with dependencies of unknown version
+        for (artifact, pom) in targets:
+            for coordinate in pom.getRequiredCoordinates():
+                (kind, groupId, artifactId, version) = coordinate
+                if '%s:%s' % (groupId, artifactId) in produced:
+                    continue
+                if '${' in (version or '') or (not version and kind != 'plugin'):
+                    unknown.add(id(artifact))
+                else:
+                    required.setdefault(coordinate, set()).add(id(artifact))
+
+        poms = [ResolvePom(index) for index in range(max(1, min(getJobs(4), len(required))))] #resolves default plugins too
+        for coordinate in sorted(required, key=str):
+            candidates = [pom for pom in poms if coordinate[:3] not in pom.keys]
+            if not candidates:
+                candidates = [ResolvePom(len(poms))]
+                poms.extend(candidates)
+            min(candidates, key=lambda pom: len(pom.coordinates)).add(coordinate)
+        log('Resolving %d dependencies and plugins of %d artifacts with %d poms'
+            % (len(required), len(targets), len(poms)))
+        resolved = runParallel(poms, ResolvePom.resolve, getJobs(4), phase='resolve')
+
+        incomplete = set(unknown)
+        for (pom, result) in zip(poms, resolved):
+            if not result:
+                for coordinate in pom.coordinates:
+                    incomplete.update(required[coordinate])
+        if incomplete:
+            warning('Dependencies of %d artifacts were not resolved completely, their builds stay online: %s'
+                    % (len(incomplete), ', '.join(sorted(artifact.name for (artifact, pom) in targets if id(artifact) in incomplete))))
+        for (artifact, pom) in targets:
+            if id(artifact) not in incomplete and not options.echoMode:
+                BuildState.record(artifact, DependencyResolution.goal, {'hash': DependencyResolution.getRequirementsHash(pom)})
+        done = set(id(artifact) for (artifact, pom) in targets) - incomplete
+        return [id(artifact) in done for artifact in selection or []]
+
+    @staticmethod
+    def getRequirementsHash(pom):
+        import hashlib
+        return hashlib.sha1('\n'.join(str(coordinate) for coordinate in pom.getRequiredCoordinates()).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def isResolved(artifact):
+        return BuildState.isUpToDate(artifact, DependencyResolution.goal,
+                                     {'hash': DependencyResolution.getRequirementsHash(readPom(artifact))})
+
+#Synthetic pom.xml in APPS_DIR/.mvnrepo-updater-resolve/pom-N with part of coordinates resolved by DependencyResolution
+class ResolvePom(object):
+    def __init__(self, index):
+        self.name = 'resolve-%d' % index
+        self.path = os.path.join(home_dir, DependencyResolution.dirname, 'pom-%d' % index)
+        self.coordinates = list()
+        self.keys = set() #(type, groupId, artifactId)
+
+    def add(self, coordinate):
+        self.coordinates.append(coordinate)
+        self.keys.add(coordinate[:3])
+
+    def write(self):
+        from xml.sax.saxutils import escape
+        dependencies = list()
+        plugins = list()
+        for (kind, groupId, artifactId, version) in self.coordinates:
+            element = '<groupId>%s</groupId><artifactId>%s</artifactId>' % (escape(groupId), escape(artifactId))
+            if version:
+                element += '<version>%s</version>' % escape(version)
+            if kind == 'plugin':
+                plugins.append('      <plugin>%s</plugin>' % element)
+            else:
+                dependencies.append('    <dependency>%s<type>%s</type></dependency>' % (element, kind))
+        changeDir(self.path)
+        with open(os.path.join(self.path, 'pom.xml'), 'w') as pom_file:
+            pom_file.write('\n'.join(['<project xmlns="http://maven.apache.org/POM/4.0.0">',
+                '  <modelVersion>4.0.0</modelVersion>',
+                '  <groupId>mvnrepo-updater</groupId>',
+                '  <artifactId>%s</artifactId>' % self.name,
+                '  <version>1</version>',
+                '  <dependencies>'] + dependencies + ['  </dependencies>',
+                '  <build>',
+                '    <plugins>'] + plugins + ['    </plugins>',
+                '  </build>',
+                '</project>', '']))
+
+    #Runs in thread of runParallel() without artifact context: synthetic pom is not an artifact of manifest
+    def resolve(self):
+        context.artifact = None
+        self.write()
+        return not maven('dependency:resolve dependency:resolve-plugins')
+
+#Scans working copies of all selected artifacts concurrently (--jobs, 8 by default) and prints
+#ones with local changes or commits as table, or status of all of them as JSON (--json)
+class StatusScan(Action):
+    def __init__(self):
+        Action.__init__(self, 'status', None, silentMode=True)
+
+    def executeAll(self, selection):
+        options.debug_mode = False
+        statuses = runParallel(selection, getRepoStatus, getJobs(8), phase=self.name)
+        statuses = [status for status in statuses if status]
+        if options.json:
+            import json
+            print(json.dumps(statuses, indent=1, sort_keys=True))
+            return statuses
+        cloned = [status for status in statuses if status['cloned']]
+        rows = [status for status in cloned if not isRepoStatusClean(status)]
+        if rows:
+            columns = ('ARTIFACT', 'BRANCH', 'AHEAD', 'BEHIND', 'STAGED', 'CHANGED', 'UNTRACKED', 'CONFLICTS')
+            table = [columns]
+            for status in rows:
+                branch = status['failed'] and 'git status failed' or status['branch'] or '-'
+                table.append((status['artifact'], branch, status['ahead'], status['behind'], status['staged'],
+                              status['changed'], status['untracked'], status['conflicts']))
+            widths = [max(len(str(row[column])) for row in table) for column in range(len(columns))]
+            for row in table:
+                print('  '.join(str(value).ljust(widths[column]) for (column, value) in enumerate(row)).rstrip())
+        not_cloned = len(statuses) - len(cloned)
+        print('%d repositories scanned, %d clean%s' % (len(statuses), len(cloned) - len(rows),
+                                                      not_cloned and ', %d not cloned' % not_cloned or ''))
+        return statuses
+
+    def execute(self, artifact):
+        return self.executeAll([artifact])
+
+#Maven project model: coordinates, parent, dependencies, plugins and modules read from pom.xml
+class Pom(object):
+    groupId = None
+    artifactId = None
+    version = None
+    parent = None
+    parentVersion = None
+
+    def __init__(self, path, parentPom=None):
+        self.path = path
+        self.properties = dict()
+        self.dependencies = list()
+        self.plugins = list()
+        self.modules = list()
+        self.managed = dict() #'groupId:artifactId' -> version from dependencyManagement and pluginManagement
+        self.imports = list() #boms imported into dependencyManagement
+        if parentPom:
+            self.groupId = parentPom.groupId
+            self.version = parentPom.version
+            self.properties.update(parentPom.properties)
+            self.managed.update(parentPom.managed)
+        if os.path.isfile(path):
+            self.parse()
+
+    def parse(self):
+        import xml.etree.ElementTree as ElementTree
+        try:
+            root = ElementTree.parse(self.path).getroot()
+        except Exception:
+            warning('Failed to parse %s: %s' % (self.path, str(sys.exc_info()[1])))
+            return
+        for element in root.iter(): #drop xml namespace: '{http://maven.apache.org/POM/4.0.0}groupId' -> 'groupId'
+            if isinstance(element.tag, str) and '}' in element.tag:
+                element.tag = element.tag.split('}', 1)[1]
+
+        parent = root.find('parent')
+        if parent is not None:
+            self.parent = (parent.findtext('groupId'), parent.findtext('artifactId'))
+            self.groupId = parent.findtext('groupId')
+            self.version = parent.findtext('version')
+            self.parentVersion = self.version
+        self.groupId = root.findtext('groupId') or self.groupId
+        self.artifactId = root.findtext('artifactId')
+        self.version = root.findtext('version') or self.version
+        properties = root.find('properties')
+        if properties is not None:
+            for prop in properties:
+                self.properties[prop.tag] = (prop.text or '').strip()
+
+        for dependency in root.findall('dependencies/dependency'):
+            self.dependencies.append(self.coordinate(dependency))
+        for plugin in root.findall('build/plugins/plugin') + root.findall('build/extensions/extension'):
+            self.plugins.append(self.coordinate(plugin, 'org.apache.maven.plugins'))
+        for dependency in root.findall('dependencyManagement/dependencies/dependency'):
+            (groupId, artifactId, version) = self.coordinate(dependency)
+            if dependency.findtext('scope') == 'import':
+                self.imports.append((groupId, artifactId, version))
+            else:
+                self.managed['%s:%s' % (groupId, artifactId)] = version
+        for plugin in root.findall('build/pluginManagement/plugins/plugin'):
+            (groupId, artifactId, version) = self.coordinate(plugin, 'org.apache.maven.plugins')
+            self.managed['%s:%s' % (groupId, artifactId)] = version
+        directory = os.path.dirname(self.path)
+        for module in root.findall('modules/module'):
+            if module.text:
+                self.modules.append(Pom(os.path.join(directory, module.text.strip(), 'pom.xml'), self))
+
+    def coordinate(self, element, defaultGroupId=None):
+        return (self.interpolate(element.findtext('groupId') or defaultGroupId),
+                self.interpolate(element.findtext('artifactId')),
+                self.interpolate(element.findtext('version')))
+
+    #Resolves ${project.*} and ${property} placeholders known to this pom
+    def interpolate(self, value):
+        if not value or '${' not in value:
+            return value and value.strip()
+        values = dict(self.properties)
+        values.update({'project.groupId': self.groupId, 'pom.groupId': self.groupId,
+                       'project.artifactId': self.artifactId, 'project.version': self.version, 'pom.version': self.version})
+        for i in range(5): #properties may refer to other properties
+            for (key, replacement) in values.items():
+                if replacement is not None:
+                    value = value.replace('${%s}' % key, replacement)
+            if '${' not in value:
+                break
+        return value.strip()
+
+    def getAllPoms(self):
+        poms = [self]
+        for module in self.modules:
+            poms.extend(module.getAllPoms())
+        return poms
+
+    #'groupId:artifactId' of all projects built by this pom (including modules)
+    def getProducedKeys(self):
+        return set('%s:%s' % (pom.groupId, pom.artifactId) for pom in self.getAllPoms() if pom.artifactId)
+
+    #'groupId:artifactId' of parents, dependencies and plugins required to build this pom
+    def getRequiredKeys(self):
+        required = set()
+        for pom in self.getAllPoms():
+            if pom.parent:
+                required.add('%s:%s' % pom.parent)
+            for (groupId, artifactId, version) in pom.dependencies + pom.plugins:
+                required.add('%s:%s' % (groupId, artifactId))
+        return required - self.getProducedKeys()
+
+    #Coordinates which maven downloads to build this pom: (type, groupId, artifactId, version) of parents and imported
+    #boms ('pom'), dependencies ('jar') and plugins ('plugin'). Versions missing in pom are taken from
+    #dependencyManagement/pluginManagement, None if unknown (plugins without version get maven defaults)
+    def getRequiredCoordinates(self):
+        produced = self.getProducedKeys()
+        coordinates = set()
+        for pom in self.getAllPoms():
+            required = [('pom', pom.imports)]
+            if pom.parent:
+                required.append(('pom', [pom.parent + (pom.parentVersion,)]))
+            required.extend([('jar', pom.dependencies), ('plugin', pom.plugins)])
+            for (kind, entries) in required:
+                for (groupId, artifactId, version) in entries:
+                    key = '%s:%s' % (groupId, artifactId)
+                    if key not in produced:
+                        coordinates.add((kind, groupId, artifactId, version or pom.managed.get(key)))
+        return sorted(coordinates, key=str)
+
+def readPom(artifact):
+    return Pom(os.path.join(artifact.getAbsoluteLocationDir(), 'pom.xml'))
+
+#Dependency graph of selected artifacts. Edges are taken from groupId:artifactId of parents,
+#dependencies and plugins declared in pom.xml files of the selection
+class BuildGraph(object):
+    def __init__(self, selection, poms=None):
+        self.selection = selection
+        self.estimates = None
+        self.order = None
+        self.poms = poms or [readPom(artifact) for artifact in selection]
+        producers = dict()
+        for (index, pom) in enumerate(self.poms):
+            for key in pom.getProducedKeys():
+                producers.setdefault(key, index)
+        self.dependencies = list()
+        for (index, pom) in enumerate(self.poms):
+            upstream = set(producers[key] for key in pom.getRequiredKeys() if key in producers)
+            upstream.discard(index)
+            self.dependencies.append(sorted(upstream))
+        self.dependents = [list() for artifact in selection]
+        for (index, upstream) in enumerate(self.dependencies):
+            for dependency in upstream:
+                self.dependents[dependency].append(index)
+        #same working copy selected with several branches: builds run one after another, whatever their results are
+        self.after = list()
+        previous = dict()
+        for (index, artifact) in enumerate(selection):
+            location = artifact.getLocationDir()
+            self.after.append([previous[location]] if location in previous else [])
+            previous[location] = index
+
+    #Topological levels: artifacts in wave N depend only on artifacts from waves < N
+    def getWaves(self):
+        level = dict()
+        def depth(index, visiting):
+            if index not in level:
+                if index in visiting: #dependency cycle
+                    return 0
+                visiting.add(index)
+                level[index] = 1 + max([depth(dependency, visiting) for dependency in self.dependencies[index]] or [-1])
+                visiting.discard(index)
+            return level[index]
+        waves = list()
+        for index in range(len(self.selection)):
+            wave = depth(index, set())
+            while len(waves) <= wave:
+                waves.append(list())
+            waves[wave].append(index)
+        return waves
+
+    #Runs callback(artifact) as soon as all artifacts it depends on are built, using up to 'jobs' threads.
+    #Returns list of results: True - built, False - failed, None - skipped
+    def run(self, callback, jobs=1, failed=(), phase=None, done=()):
+        for (number, wave) in enumerate(self.getWaves()):
+            log('Build wave %d: %s' % (number + 1, ', '.join(self.selection[index].name for index in wave)))
+        state = ['pending'] * len(self.selection)
+        results = [None] * len(self.selection)
+        condition = threading.Condition()
+        for index in done: #built by resumed run
+            state[index] = 'done'
+            results[index] = True
+        for index in failed:
+            state[index] = 'failed'
+            results[index] = False
+        for index in failed:
+            self.skipDependents(index, state)
+
+        def nextTask():
+            running = False
+            for index in self.getOrder():
+                if state[index] == 'running':
+                    running = True
+                elif (state[index] == 'pending' and all(state[dependency] == 'done' for dependency in self.dependencies[index])
+                      and all(state[previous] not in ('pending', 'running') for previous in self.after[index])):
+                    return index
+            if not running and 'pending' in state: #only dependency cycles left
+                index = state.index('pending')
+                warning('Dependency cycle detected, building %s without waiting for its dependencies' % self.selection[index].name)
+                return index
+            return None
+
+        def worker():
+            while True:
+                with condition:
+                    index = nextTask()
+                    while index is None:
+                        if 'pending' not in state:
+                            return
+                        condition.wait()
+                        index = nextTask()
+                    state[index] = 'running'
+                result = runForArtifact(self.selection[index], callback, phase)
+                with condition:
+                    results[index] = bool(result)
+                    if result:
+                        state[index] = 'done'
+                    else:
+                        state[index] = 'failed'
+                        self.skipDependents(index, state)
+                    condition.notify_all()
+        runWorkers(min(jobs or 1, len(self.selection)), worker)
+        return results
+
+    #Artifacts of selection and all artifacts which depend on them, in selection order
+    def getWithDependents(self, artifacts):
+        marked = set(index for (index, artifact) in enumerate(self.selection) if any(artifact is selected for selected in artifacts))
+        pending = list(marked)
+        while pending:
+            for dependent in self.dependents[pending.pop()]:
+                if dependent not in marked:
+                    marked.add(dependent)
+                    pending.append(dependent)
+        return [self.selection[index] for index in sorted(marked)]
+
+    def getUpstream(self, artifact):
+        for (index, selected) in enumerate(self.selection):
+            if selected is artifact:
+                return [self.selection[dependency] for dependency in self.dependencies[index]]
+        return list()
+
+    #Expected build time of each artifact of selection in seconds, see BuildHistory
+    def setEstimates(self, estimates):
+        self.estimates = estimates
+        self.order = None
+
+    #Build order preference for artifacts which are ready at the same time: selection order, or longest critical path
+    #first if estimates are set. Critical path of artifact is its estimate plus the longest critical path of artifacts
+    #waiting for it, so long chains and long builds start early and don't set the end of the whole batch
+    def getOrder(self):
+        if self.estimates is None:
+            return range(len(self.selection))
+        if self.order is None:
+            successors = [list(dependents) for dependents in self.dependents]
+            for (index, previous) in enumerate(self.after):
+                for before in previous:
+                    successors[before].append(index)
+            paths = dict()
+            def criticalPath(index, visiting):
+                if index not in paths:
+                    if index in visiting: #dependency cycle
+                        return 0
+                    visiting.add(index)
+                    paths[index] = self.estimates[index] + max([criticalPath(successor, visiting) for successor in successors[index]] or [0])
+                    visiting.discard(index)
+                return paths[index]
+            self.order = sorted(range(len(self.selection)), key=lambda index: (-criticalPath(index, set()), index))
+        return self.order
+
+    #Predicted schedule of run() with 'jobs' threads if every build takes its estimate: list of (index, start, end)
+    def simulate(self, jobs):
+        estimates = self.estimates or [0] * len(self.selection)
+        finished = dict()
+        pending = set(range(len(self.selection)))
+        running = list() #(end, index)
+        schedule = list()
+        now = 0
+        while pending or running:
+            ready = [index for index in self.getOrder() if index in pending
+                     and all(finished.get(dependency, now + 1) <= now for dependency in self.dependencies[index] + self.after[index])]
+            if not ready and not running: #only dependency cycles left
+                ready = [index for index in self.getOrder() if index in pending][:1]
+            for index in ready[:max(1, jobs) - len(running)]:
+                pending.discard(index)
+                running.append((now + estimates[index], index))
+                schedule.append((index, now, now + estimates[index]))
+            running.sort()
+            (now, index) = running.pop(0)
+            finished[index] = now
+        return schedule
+
+    def skipDependents(self, index, state, failedIndex=None):
+        if failedIndex is None:
+            failedIndex = index
+        for dependent in self.dependents[index]:
+            if state[dependent] == 'pending':
+                state[dependent] = 'skipped'
+                warning('%s skipped: depends on %s which failed' % (self.selection[dependent].name, self.selection[failedIndex].name))
+                self.skipDependents(dependent, state, failedIndex)
+
+#Replaces file with data (str or bytes) by renaming unique temp file written next to it: readers never see partial
+#file and processes sharing apps dir (--watch and cron runs, workers) don't write the same temp file
+def writeFileAtomically(path, data):
+    import tempfile
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    (handle, temp_path) = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(data)
+        os.chmod(temp_path, int('644', 8))
+        if hasattr(os, 'replace'):
+            os.replace(temp_path, path)
+        else: #python 2
+            if os.path.exists(path) and sys.platform.startswith('win32'):
+                os.remove(path)
+            os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+#Dict stored as JSON in file, empty if file is missing. Corrupted file is ignored with warning (mesg % path)
+def readJsonStore(path, mesg):
+    import json
+    if os.path.isfile(path):
+        try:
+            with open(path) as store_file:
+                return json.load(store_file)
+        except ValueError:
+            warning(mesg % path)
+    return dict()
+
+def writeJsonStore(path, records):
+    import json
+    writeFileAtomically(path, json.dumps(records, indent=1, sort_keys=True))
+
+#Inputs of last successful incremental maven builds, stored in home_dir/.mvnrepo-updater.state
+#as {'organisation/name': {'--deploy': {'hash': ..., 'head': ..., 'time': ...}}}
+class BuildState(object):
+    filename = '.mvnrepo-updater.state'
+    records = None
+    inputs = dict() #id(artifact) -> inputs hash calculated in this run
+    producers = None #'groupId:artifactId' -> location of artifact producing it, from 'produced' of records
+    skipped = list()
+    lock = threading.RLock()
+
+    @staticmethod
+    def getRecords():
+        with BuildState.lock:
+            if BuildState.records is None:
+                BuildState.records = readJsonStore(os.path.join(home_dir, BuildState.filename),
+                                                   'Build state file %s is corrupted, all artifacts will be rebuilt')
+            return BuildState.records
+
+    #Hash of everything the build result depends on: HEAD commit, uncommitted changes, maven flags and inputs of
+    #upstream artifacts: of selected ones from this run, of artifacts outside of selection which produce required
+    #keys of pom.xml from their last recorded build
+    @staticmethod
+    def getInputs(artifact, maven_command, upstream=(), goal=None):
+        import hashlib
+        head = getHeadCommit()
+        pom = readPom(artifact)
+        digest = hashlib.sha1()
+        digest.update(('head %s\n' % head).encode('utf-8'))
+        digest.update(('flags %s %s %s\n' % (maven_command, maven_opts, options.skipTests)).encode('utf-8'))
+        digest.update(getWorkingTreeFingerprint().encode('utf-8'))
+        hashes = dict((dependency.getLocationDir(), BuildState.inputs.get(id(dependency))) for dependency in upstream)
+        for key in pom.getRequiredKeys():
+            location = BuildState.getProducers().get(key)
+            if location and location not in hashes and location != artifact.getLocationDir():
+                hashes[location] = BuildState.getRecordedHash(location, goal)
+        for location in sorted(hashes):
+            digest.update(('upstream %s %s\n' % (location, hashes[location])).encode('utf-8'))
+        inputs = {'hash': digest.hexdigest(), 'head': head, 'produced': sorted(pom.getProducedKeys())}
+        with BuildState.lock:
+            BuildState.inputs[id(artifact)] = inputs['hash']
+        return inputs
+
+    @staticmethod
+    def getProducers():
+        with BuildState.lock:
+            if BuildState.producers is None:
+                BuildState.producers = dict()
+                for (location, goals) in BuildState.getRecords().items():
+                    for record in goals.values():
+                        for key in record.get('produced') or []:
+                            BuildState.producers[key] = location
+            return BuildState.producers
+
+    #Hash of last build of artifact at location: build of goal, or the latest build of other goal
+    @staticmethod
+    def getRecordedHash(location, goal):
+        goals = BuildState.getRecords().get(location, dict())
+        if goal in goals:
+            return goals[goal].get('hash')
+        builds = sorted((record.get('time', ''), record.get('hash')) for record in goals.values() if 'produced' in record)
+        return builds and builds[-1][1] or None
+
+    #Artifact built by resumed run is not built again: its dependents take its inputs from the recorded state
+    @staticmethod
+    def restoreInputs(artifact, goal):
+        record = BuildState.getRecords().get(artifact.getLocationDir(), dict()).get(goal)
+        if record:
+            with BuildState.lock:
+                BuildState.inputs[id(artifact)] = record.get('hash')
+
+    @staticmethod
+    def isUpToDate(artifact, goal, inputs):
+        record = BuildState.getRecords().get(artifact.getLocationDir(), dict()).get(goal)
+        return bool(record) and record.get('hash') == inputs['hash']
+
+    @staticmethod
+    def record(artifact, goal, inputs):
+        with BuildState.lock:
+            records = BuildState.getRecords()
+            record = dict(inputs)
+            record['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+            records.setdefault(artifact.getLocationDir(), dict())[goal] = record
+            BuildState.producers = None
+            writeJsonStore(os.path.join(home_dir, BuildState.filename), records)
+
+#Durations of successful maven builds, stored in home_dir/.mvnrepo-updater.history as
+#{'organisation/name': {'--deploy': {'estimate': seconds, 'last': seconds, 'builds': N}}}. Estimate is exponentially
+#weighted moving average, so it follows artifacts which become slower or faster but isn't thrown off by one slow build
+class BuildHistory(object):
+    filename = '.mvnrepo-updater.history'
+    weight = 0.3 #weight of the last build in estimate
+    default_estimate = 60
+    records = None
+    lock = threading.RLock()
+
+    @staticmethod
+    def getRecords():
+        with BuildHistory.lock:
+            if BuildHistory.records is None:
+                BuildHistory.records = readJsonStore(os.path.join(home_dir, BuildHistory.filename),
+                                                     'Build history file %s is corrupted, build order is not optimized')
+            return BuildHistory.records
+
+    @staticmethod
+    def record(artifact, goal, duration):
+        if options.echoMode:
+            return
+        with BuildHistory.lock:
+            records = BuildHistory.getRecords()
+            record = records.setdefault(artifact.getLocationDir(), dict()).get(goal)
+            if record:
+                estimate = BuildHistory.weight * duration + (1 - BuildHistory.weight) * record['estimate']
+                record = {'estimate': estimate, 'last': duration, 'builds': record.get('builds', 0) + 1}
+            else:
+                record = {'estimate': duration, 'last': duration, 'builds': 1}
+            records[artifact.getLocationDir()][goal] = dict((key, round(value, 1)) for (key, value) in record.items())
+            writeJsonStore(os.path.join(home_dir, BuildHistory.filename), records)
+
+    #Estimates of goal for artifacts of selection, artifacts without history get average estimate of the others
+    @staticmethod
+    def getEstimates(selection, goal):
+        records = BuildHistory.getRecords()
+        estimates = [records.get(artifact.getLocationDir(), dict()).get(goal, dict()).get('estimate') for artifact in selection]
+        known = [estimate for estimate in estimates if estimate is not None]
+        default = known and sum(known) / len(known) or BuildHistory.default_estimate
+        return [estimate is None and default or estimate for estimate in estimates]
+
+    @staticmethod
+    def isKnown(artifact, goal):
+        return goal in BuildHistory.getRecords().get(artifact.getLocationDir(), dict())
+
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    return '%d:%02d' % (seconds // 60, seconds % 60)
+
+#Prints predicted schedule of maven goal (--plan): build order and times with --jobs threads, estimated by BuildHistory
+def showPlan(selection):
+    action = options.action and Repository.getAction(options.action)
+    if not isinstance(action, MavenGoal):
+        fatal('--plan needs a maven goal (-d, -t, -c)')
+        return
+    graph = BuildGraph(selection)
+    graph.setEstimates(BuildHistory.getEstimates(selection, action.name))
+    jobs = getJobs()
+    if options.workers:
+        jobs = len(options.workers.split(','))
+    schedule = graph.simulate(jobs)
+    print('Predicted schedule of mvn %s with %d jobs (* - no build history, average estimate is used):' % (action.maven_command, jobs))
+    table = [('START', 'END', 'ESTIMATE', 'ARTIFACT')]
+    for (index, start, end) in sorted(schedule, key=lambda entry: (entry[1], entry[2])):
+        artifact = selection[index]
+        name = artifact.name + (artifact.branch and '#' + artifact.branch or '')
+        if not BuildHistory.isKnown(artifact, action.name):
+            name += ' *'
+        table.append((formatDuration(start), formatDuration(end), formatDuration(end - start), name))
+    widths = [max(len(row[column]) for row in table) for column in range(3)]
+    for row in table:
+        print('  '.join([row[column].rjust(widths[column]) for column in range(3)] + [row[3]]))
+    total = max([end for (index, start, end) in schedule] or [0])
+    print('Predicted total time: %s (%s if built one by one). Up to date artifacts (see --force) are skipped at run time'
+          % (formatDuration(total), formatDuration(sum(graph.estimates))))
+
+#Identifies uncommitted changes: changed/untracked paths with their size and mtime plus the diff itself
+def getWorkingTreeFingerprint():
+    import hashlib
+    status = callAndGetOutput('git status --porcelain --untracked-files=all', log=False)
+    if not status.strip():
+        return 'clean'
+    digest = hashlib.sha1(status.encode('utf-8'))
+    digest.update(callAndGetOutput('git diff HEAD --binary', log=False).encode('utf-8'))
+    for line in status.splitlines():
+        path = os.path.join(getCwd(), line[3:].split(' -> ')[-1].strip('"'))
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            digest.update(('%s %d %d\n' % (path, stat.st_size, int(stat.st_mtime))).encode('utf-8'))
+    return 'dirty ' + digest.hexdigest()
 
 def default(name):
     print('DefaultAction empty callback function')
 
 class Repository(object):
     artifacts = list()
+    names = dict()    #name -> indexes of artifacts with this name (same name may exist in several organisations)
+    paths = dict()    #'organisation/name' -> artifact index
+    trigrams = None   #3 chars substring of name -> set of artifact indexes, built when substring searches are frequent
+    substring_searches = 0
     action_map = dict()
     default_action = Action('default', default, silentMode=False, changedir=False)
 
     @staticmethod
     def put(repo):
+        index = len(Repository.artifacts)
         Repository.artifacts.append(repo)
+        Repository.names.setdefault(repo.name, list()).append(index)
+        Repository.paths.setdefault(repo.getPath(), index)
+        Repository.trigrams = None
+
+    @staticmethod
+    def getTrigrams():
+        if Repository.trigrams is None:
+            trigrams = dict()
+            for (index, repo) in enumerate(Repository.artifacts):
+                for start in range(len(repo.name) - 2):
+                    trigrams.setdefault(repo.name[start:start + 3], set()).add(index)
+            Repository.trigrams = trigrams
+        return Repository.trigrams
 
     @staticmethod
     def addAction(action):
         if isinstance(action, Action):
             Repository.action_map[action.name] = action
 
+    @staticmethod
+    def getAction(name):
+        return Repository.action_map.get(name, Repository.default_action)
+
     @staticmethod
     def applyAction(name, target):
-        action = Repository.action_map.get(name, Repository.default_action)
-        action.execute(target)
+        return Repository.getAction(name).execute(target)
 
-    #artifacts_list will be populated by all artifacts, which contains 'name' in name
+    #artifacts_list will be populated by all artifacts matching selector 'name' (see find()), which are not selected yet
     @staticmethod
     def resolve(name, artifacts_list):
         if isinstance(name, list) and len(name) == 1:
@@ -345,22 +2495,65 @@ class Repository(object):
             log(error_mesg)
             raise Exception(error_mesg)
 
-        for repo in Repository.artifacts:
-            if name == '*' or (repo.name and name in repo.name):
+        selected = set(id(repo) for repo in artifacts_list)
+        for repo in Repository.find(name):
+            if id(repo) not in selected:
+                selected.add(id(repo))
                 artifacts_list.append(repo)
 
-    #Resolve artifact by name
+    #Artifacts matching selector, in artifacts.txt order. Selectors:
+    #'*' - all, 're:<regex>' - regex search in name or organisation/name, 'org/*' - glob on organisation/name
+    #('*spring*' - glob on name), 'organisation/name' - exact, otherwise substring of name
+    @staticmethod
+    def find(selector):
+        if selector == '*':
+            return list(Repository.artifacts)
+        if selector.startswith('re:'):
+            import re
+            try:
+                pattern = re.compile(selector[3:])
+            except re.error as e:
+                fatal("Failed to resolve artifacts, invalid regex '%s': %s" % (selector[3:], e))
+                sys.exit(1)
+            return [repo for repo in Repository.artifacts if pattern.search(repo.name) or pattern.search(repo.getPath())]
+        if '*' in selector or '?' in selector or '[' in selector:
+            import fnmatch
+            if '/' in selector:
+                return [repo for repo in Repository.artifacts if fnmatch.fnmatchcase(repo.getPath(), selector)]
+            return [repo for repo in Repository.artifacts if fnmatch.fnmatchcase(repo.name, selector)]
+        if '/' in selector:
+            index = Repository.paths.get(selector)
+            return [Repository.artifacts[index]] if index is not None else []
+        Repository.substring_searches += 1
+        if len(selector) < 3 or (Repository.trigrams is None and Repository.substring_searches <= 16):
+            return [repo for repo in Repository.artifacts if repo.name and selector in repo.name]
+        trigrams = Repository.getTrigrams()
+        postings = sorted([trigrams.get(selector[start:start + 3], set()) for start in range(len(selector) - 2)], key=len)
+        candidates = postings[0]
+        for indexes in postings[1:]: #intersect starting from the rarest trigram, verify the rest by substring test
+            if len(candidates) <= 32:
+                break
+            candidates = candidates & indexes
+        return [Repository.artifacts[index] for index in sorted(candidates) if selector in Repository.artifacts[index].name]
+
+    #Resolve artifact by exact name or organisation/name. Exits if name is unknown or ambiguous
     @staticmethod
     def resolveOne(name):
-        artifact = None
-        for repo in Repository.artifacts:
-            if name == repo.name:
-                artifact = repo
-        if not artifact:
+        if '/' in name:
+            indexes = [Repository.paths[name]] if name in Repository.paths else []
+        else:
+            indexes = Repository.names.get(name, [])
+        if not indexes:
             print("Failed to resolve artifact, unknown name: " + name)
             sys.exit()
-        return artifact
+        if len(indexes) > 1:
+            print("Failed to resolve artifact, name '%s' is ambiguous. Use one of: %s"
+                  % (name, ', '.join(Repository.artifacts[index].getPath() for index in indexes)))
+            sys.exit(1)
+        return Repository.artifacts[indexes[0]]
 
+    #Loads parsed artifacts from compiled cache (filename + '.cache') if it matches mtime and size of artifacts file,
+    #otherwise parses urls of artifacts file and rewrites the cache
     @staticmethod
     def loadFromFile(filename):
         if not os.path.exists(filename):
@@ -369,93 +2562,571 @@ class Repository(object):
         if not os.path.isfile(filename):
             fatal("Failed to load artifact urls from file! '%s' is not a file" % filename)
             sys.exit(2)
-        urls_file = open(filename)
-        lines = urls_file.readlines()
-        urls_file.close()
-        for line in lines:
-            line = line.strip()
-            if line:
-                Repository.put(Artifact(line))
+        stat = os.stat(filename)
+        cache_key = (manifest_cache_version, tuple(sys.version_info[:2]), stat.st_mtime, stat.st_size)
+        records = Repository.readManifestCache(filename + '.cache', cache_key)
+        if records is None:
+            applicationStabilityTest()
+            urls_file = open(filename)
+            lines = urls_file.readlines()
+            urls_file.close()
+            records = list()
+            for line in lines:
+                parts = line.split()
+                if parts:
+                    artifact = Artifact(parts[0])
+                    artifact.cloneOptions = parseCloneOptions(parts[1:], line.strip())
+                    records.append(artifact.toRecord())
+            Repository.writeManifestCache(filename + '.cache', cache_key, records)
+        for record in records:
+            Repository.put(Artifact.fromRecord(record))
+
+    @staticmethod
+    def readManifestCache(path, cache_key):
+        import marshal
+        try:
+            with open(path, 'rb') as cache_file:
+                (key, records) = marshal.loads(cache_file.read()) #much faster than marshal.load(file)
+        except Exception: #missing, corrupted or written by other python version
+            return None
+        if tuple(key) != cache_key:
+            return None
+        return records
 
+    @staticmethod
+    def writeManifestCache(path, cache_key, records):
+        import marshal
+        try:
+            writeFileAtomically(path, marshal.dumps((cache_key, records)))
+        except (IOError, OSError):
+            log('Failed to write manifest cache %s: %s' % (path, str(sys.exc_info()[1])))
+
+#Returns command stdout. Stdout (if log is set) and stderr lines are written to log file as they arrive
 def callAndGetOutput(cmd, log=True):
     if log:
         logExecutedCommand(cmd)
     if options.echoMode:
         return ""
 
+    start = time.time()
     try:
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        (stdoutdata, stderrdata) = process.communicate()
-        if stdoutdata:
-            log2file("STDOUT: ")
-            log2file(stdoutdata)
-        if stderrdata:
-            logExecutedCommand("!!STDERR: " + str(stderrdata))
-        if sys.version_info >= (3, 0):
-            return str(stdoutdata, "utf-8") #converts binary string
-        else:
-            return str(stdoutdata)
+        import subprocess
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=getCwd())
+        artifact = currentArtifact()
+        def logStderr():
+            context.artifact = artifact
+            for line in readLines(process.stderr):
+                log2file("STDERR: " + line)
+        stderr_reader = threading.Thread(target=logStderr)
+        stderr_reader.daemon = True
+        stderr_reader.start()
+        stdoutdata = list()
+        for line in readLines(process.stdout):
+            stdoutdata.append(line + '\n')
+            if log:
+                log2file("STDOUT: " + line)
+        code = process.wait()
+        stderr_reader.join()
+        recordTiming('callAndGetOutput', cmd, start, code)
+        return ''.join(stdoutdata)
     except Exception:
         warning('[Error] executing command: ' + cmd)
         warning(str(sys.exc_info()[1]))
 
-def call(cmd, log=True):
+#Runs command and streams its output (stdout and stderr) line by line to console (unless quiet is set) and log file.
+#Console lines are prefixed with artifact name and time unless prefix=False. Only last lines of
+#output are kept in memory: they are shown by showFailures() if command exits with error
+def call(cmd, log=True, prefix=True, kind='call', quiet=False, env=None):
     if log:
         logExecutedCommand(cmd)
     if not options.echoMode:
+        start = time.time()
         try:
-            return subprocess.call(cmd, shell=True)
+            import subprocess
+            import collections
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True, cwd=getCwd(), env=env)
+            artifact = currentArtifact()
+            sink = getattr(context, 'sink', None) #streams output of worker jobs to coordinator
+            tail = collections.deque(maxlen=getattr(options, 'tail_lines', None) or 30)
+            for line in readLines(process.stdout):
+                stamp = time.strftime('%H:%M:%S')
+                tail.append(line)
+                log2file("OUT %s: %s" % (stamp, line))
+                if quiet:
+                    continue
+                with output_lock:
+                    if prefix:
+                        sys.stdout.write('[%s %s] ' % (artifact and artifact.name or '-', stamp))
+                    sys.stdout.write(line + '\n')
+                    sys.stdout.flush()
+                if sink:
+                    sink(line)
+            code = process.wait()
+            recordTiming(kind, cmd, start, code)
+            if code and log:
+                with output_lock:
+                    failures.append((artifact, (cmd, code, list(tail))))
+            return code
         except Exception:
             warning('[Error] executing command: ' + cmd)
             warning(str(sys.exc_info()[1]))
 
-def maven(cmd):
-    if sys.platform.startswith('win32'):
-        cmd = 'mvn.bat ' + cmd
-    else:
-        cmd = 'mvn ' + cmd
+#Stores start/end time of command or artifact phase ('kind' is call, callAndGetOutput, maven or phase)
+def recordTiming(kind, name, start, code):
+    if options and options.profile:
+        record = {'kind': kind, 'name': name, 'start': start, 'end': time.time(), 'code': code,
+                  'phase': getattr(context, 'phase', None), 'thread': threading.current_thread().name}
+        with output_lock:
+            command_timings.append((currentArtifact(), record))
+
+#Prints slowest artifacts, phases and commands and writes all timings as Chrome trace-event JSON
+#(open it in chrome://tracing or https://ui.perfetto.dev to see overlapping work and the critical path)
+def showProfile():
+    if not options.profile or not command_timings:
+        return
+    artifact_totals = dict()
+    phase_totals = dict()
+    commands = list()
+    for (artifact, record) in command_timings:
+        duration = record['end'] - record['start']
+        if record['kind'] == 'phase':
+            name = artifact and artifact.name or '-'
+            artifact_totals[name] = artifact_totals.get(name, 0) + duration
+            phase_totals[record['name']] = phase_totals.get(record['name'], 0) + duration
+        else:
+            commands.append((duration, artifact and artifact.name or '-', record['name']))
+    def top(totals):
+        return sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:10]
+    print('Slowest artifacts (sum of phase times):')
+    for (name, duration) in top(artifact_totals):
+        print('%9.2fs  %s' % (duration, name))
+    print('Phases (sum over artifacts):')
+    for (name, duration) in top(phase_totals):
+        print('%9.2fs  %s' % (duration, name))
+    print('Slowest commands:')
+    for (duration, name, cmd) in sorted(commands, reverse=True)[:10]:
+        print('%9.2fs  %s: %s' % (duration, name, cmd))
+    writeTrace(options.trace_file or os.path.join(home_dir, 'mvnrepo-updater-trace.json'))
+
+def writeTrace(path):
+    import json
+    events = list()
+    threads = dict()
+    origin = min(record['start'] for (artifact, record) in command_timings)
+    for (artifact, record) in command_timings:
+        tid = threads.setdefault(record['thread'], len(threads) + 1)
+        events.append({'name': record['name'], 'cat': record['phase'] or record['kind'], 'ph': 'X', 'pid': 1, 'tid': tid,
+                       'ts': int((record['start'] - origin) * 1000000), 'dur': int((record['end'] - record['start']) * 1000000),
+                       'args': {'artifact': artifact and artifact.name, 'kind': record['kind'], 'exit_code': record['code']}})
+    for (name, tid) in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}})
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+    print('Trace written to ' + path)
+
+#Yields decoded lines of process pipe without line endings. Only the last part of progress lines ('\r') is kept
+def readLines(pipe):
+    for line in iter(pipe.readline, b''):
+        if not isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        yield line.rstrip('\r\n').split('\r')[-1]
+    pipe.close()
+
+#Last output lines of failed commands, printed at the end of run
+def showFailures():
+    if failures:
+        print('Failed commands:')
+    for (artifact, (cmd, code, tail)) in sorted(failures, key=lambda record: run_order.get(id(record[0]), -1)):
+        name = artifact and artifact.name or '-'
+        print('[%s] %s (exit code %d), last %d lines of output:' % (name, cmd, code, len(tail)))
+        for line in tail:
+            print('[%s]   %s' % (name, line))
+
+#Runs maven goal with (threads, heap MB) share of ResourceBudget if it's set
+def maven(cmd, share=None):
     cmd += maven_opts
     if options.skipTests:
         cmd += ' -Dmaven.test.skip=true'
-    call(cmd)
+    heap = None
+    if share:
+        (threads, heap) = share
+        if threads > 1 and '-T' not in cmd.split():
+            cmd += ' -T %d' % threads
+    return getMavenExecutor().run(cmd, heap)
+
+maven_executor = None
+
+#Executor of maven builds selected by --executor, created on first build. Its run(args, heap) runs maven with
+#arguments in working dir of current thread and returns exit code, heap is max heap size in MB
+def getMavenExecutor():
+    global maven_executor
+    with output_lock:
+        if maven_executor is None:
+            if getattr(options, 'executor', None) == 'daemon':
+                maven_executor = DaemonExecutor(options.daemon_command, options.daemon_pool or getJobs(),
+                                                options.daemon_max_builds, options.daemon_max_memory)
+            else:
+                maven_executor = SubprocessExecutor()
+        return maven_executor
+
+#New mvn process (and JVM) for every build, heap is set by -Xmx in MAVEN_OPTS
+class SubprocessExecutor(object):
+    def run(self, args, heap=None):
+        env = None
+        if heap:
+            env = dict(os.environ)
+            env['MAVEN_OPTS'] = ('%s -Xmx%dm' % (env.get('MAVEN_OPTS', ''), heap)).strip()
+        if sys.platform.startswith('win32'):
+            return call('mvn.bat ' + args, kind='maven', env=env)
+        return call('mvn ' + args, kind='maven', env=env)
+
+#Builds with maven daemon (mvnd, or --daemon-command with the same command line) which keeps build JVMs warm between
+#builds. Pool has --daemon-pool slots, each slot has own daemon registry (-Dmvnd.daemonStorage) in
+#APPS_DIR/.mvnrepo-updater-daemons/slot-N, so it runs one build at a time and its daemon is reused by next builds.
+#Daemon of slot is stopped (and started again by next build) after --daemon-max-builds builds, or when resident
+#memory reported by '--status' exceeds --daemon-max-memory MB. Build counts are kept in slot dirs between runs.
+#Heap of warm daemons isn't changed per build (daemon with other JVM options would be started), only -T is used
+class DaemonExecutor(object):
+    dirname = '.mvnrepo-updater-daemons'
+
+    def __init__(self, command, pool, maxBuilds, maxMemory):
+        try:
+            import queue
+        except ImportError: #python 2
+            import Queue as queue
+        self.command = command
+        self.maxBuilds = maxBuilds
+        self.maxMemory = maxMemory
+        self.slots = queue.Queue()
+        for index in range(max(1, pool)):
+            self.slots.put(os.path.join(home_dir, DaemonExecutor.dirname, 'slot-%d' % index))
+
+    def run(self, args, heap=None):
+        slot = self.slots.get()
+        try:
+            if not os.path.isdir(slot) and not options.echoMode:
+                os.makedirs(slot)
+            code = call('%s -Dmvnd.daemonStorage="%s" %s' % (self.command, slot, args), kind='maven')
+            if options.echoMode:
+                return code
+            builds = self.readBuilds(slot) + 1
+            memory = self.maxMemory and self.getMemory(slot)
+            if builds >= self.maxBuilds or (memory and memory > self.maxMemory):
+                log('Stopping maven daemon of %s after %d builds, %s MB used' % (slot, builds, memory or '?'))
+                call('%s --stop -Dmvnd.daemonStorage="%s"' % (self.command, slot), log=False, quiet=True)
+                builds = 0
+            with open(os.path.join(slot, 'builds'), 'w') as builds_file:
+                builds_file.write(str(builds))
+            return code
+        finally:
+            self.slots.put(slot)
+
+    def readBuilds(self, slot):
+        try:
+            with open(os.path.join(slot, 'builds')) as builds_file:
+                return int(builds_file.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    #Resident memory of daemons of slot in MB: sum of RSS column ('512m', '1.2g', '300000k') of '--status' table
+    def getMemory(self, slot):
+        import re
+        output = callAndGetOutput('%s --status -Dmvnd.daemonStorage="%s"' % (self.command, slot), log=False) or ''
+        units = {'k': 1.0 / 1024, 'm': 1, 'g': 1024}
+        memory = 0
+        for line in output.splitlines()[1:]:
+            sizes = re.findall(r'\s(\d+(?:\.\d+)?)([kmg])b?\s', ' %s ' % line.lower())
+            if sizes:
+                memory += float(sizes[0][0]) * units[sizes[0][1]]
+        return int(memory)
 
 def fatal(mesg):
     log2file('!FATAL! ' + mesg)
     print(mesg)
+    sink = getattr(context, 'sink', None)
+    if sink:
+        sink(mesg)
 
 def log(mesg):
     log2file('[DEBUG] ' + mesg)
     if options.debug_mode:
-        print(mesg)
+        with output_lock:
+            print(mesg)
 
 #All warning messages are cached and will be printed only on showWarnings() call
 def warning(mesg):
     if mesg:
         log2file('[WARN] ' + mesg)
-        warnings.append(mesg)
+        with output_lock:
+            warnings.append((currentArtifact(), mesg))
 
 def showWarnings():
     if warnings:
         print("Warning messages:")
-    for text in warnings:
+    for text in inRunOrder(warnings):
         print(text)
 
 #All commands are cached and will be printed only on showExecutedCommands() call
 def logExecutedCommand(cmd):
     log2file('call ' + cmd)
-    executed_commands.append(cmd)
+    with output_lock:
+        executed_commands.append((currentArtifact(), cmd))
 
 def showExecutedCommands():
     if executed_commands:
         print('Commands below was executed in shell:')
-    for command in executed_commands:
+    for command in inRunOrder(executed_commands):
         print(command)
 
-def log2file(mesg):
-    global log_file
-    if not log_file:
-        log_file = open(os.path.join(home_dir, '.mvnrepo-updater.log'), 'a')
-    log_file.write("\n" + str(mesg))
+#Sorts (artifact, message) records by artifact selection order; messages of each artifact keep their own order
+def inRunOrder(records):
+    def key(record):
+        if record[0] is None:
+            return -1
+        return run_order.get(id(record[0]), len(run_order))
+    out = list()
+    for (artifact, mesg) in sorted(records, key=key):
+        if artifact is not None and options and getJobs() > 1:
+            mesg = '%s: %s' % (artifact.name, mesg)
+        out.append(mesg)
+    return out
+
+#Writes message to run log, to stream of given artifact (artifact of current thread by default)
+def log2file(mesg, artifact=None):
+    artifact = artifact or currentArtifact()
+    if isinstance(artifact, Artifact):
+        RunLog.write(artifact.getLocationDir(), str(mesg))
+    else:
+        RunLog.write(getattr(artifact, 'name', None) or RunLog.global_key, str(mesg))
+
+#Log of runs in APPS_DIR/.mvnrepo-updater-logs. Messages are buffered per artifact and written in blocks (when
+#buffers reach block_size or flush_interval passed since last write). Every block is a separate gzip member
+#appended to segment file of the run (so whole segment is still readable by zcat), run-N.index.json keeps segments
+#of run N and (segment, offset, length) of blocks of each artifact: --logs ARTIFACT decompresses only its blocks.
+#Segment is rotated after --log-segment-size MB or a day, oldest segments of all runs are removed when they are
+#older than --log-max-age days or take more than --log-max-size MB together
+class RunLog(object):
+    dirname = '.mvnrepo-updater-logs'
+    block_size = 64 * 1024
+    flush_interval = 5
+    segment_age = 24 * 3600
+    global_key = '-'    #stream of messages not related to artifact
+    disabled = False
+    index = None        #index of current run, run is started on first write of a block
+    pending = dict()    #artifact key -> buffered lines
+    pending_size = 0
+    last_flush = time.time()
+    segment = None      #current segment file
+    segment_size = 0
+    segment_started = None
+
+    @staticmethod
+    def getDir():
+        return os.path.join(home_dir, RunLog.dirname)
+
+    @staticmethod
+    def getIndexPath(run):
+        return os.path.join(RunLog.getDir(), 'run-%06d.index.json' % run)
+
+    #Numbers of runs with index in log dir
+    @staticmethod
+    def getRuns():
+        import re
+        if not os.path.isdir(RunLog.getDir()):
+            return []
+        names = [re.match(r'run-(\d+)\.index\.json$', name) for name in os.listdir(RunLog.getDir())]
+        return sorted(int(match.group(1)) for match in names if match)
+
+    @staticmethod
+    def loadIndex(run):
+        import json
+        try:
+            with open(RunLog.getIndexPath(run)) as index_file:
+                return json.load(index_file)
+        except (IOError, OSError, ValueError): #removed or just created by other run
+            return None
+
+    @staticmethod
+    def write(key, mesg):
+        with output_lock:
+            if RunLog.disabled:
+                return
+            lines = RunLog.pending.setdefault(key, list())
+            lines.append(mesg + '\n')
+            RunLog.pending_size += len(lines[-1])
+            if RunLog.pending_size >= RunLog.block_size or time.time() - RunLog.last_flush >= RunLog.flush_interval:
+                RunLog.flush()
+
+    #Writes buffered lines of each artifact as gzip member to current segment and updates index of run
+    @staticmethod
+    def flush():
+        import zlib
+        with output_lock:
+            RunLog.last_flush = time.time()
+            if not RunLog.pending or RunLog.disabled:
+                return
+            try:
+                RunLog.openSegment()
+                segment = len(RunLog.index['segments']) - 1
+                blocks = list()
+                for (key, lines) in sorted(RunLog.pending.items()):
+                    text = ''.join(lines)
+                    if not isinstance(text, bytes):
+                        text = text.encode('utf-8', 'replace')
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    block = compressor.compress(text) + compressor.flush()
+                    RunLog.index['artifacts'].setdefault(key, list()).append([segment, RunLog.segment_size, len(block)])
+                    RunLog.segment_size += len(block)
+                    blocks.append(block)
+                RunLog.segment.write(b''.join(blocks))
+                RunLog.segment.flush()
+                RunLog.writeIndex()
+            except (IOError, OSError):
+                sys.stderr.write('Failed to write run log to %s: %s\n' % (RunLog.getDir(), str(sys.exc_info()[1])))
+                RunLog.disabled = True
+            RunLog.pending = dict()
+            RunLog.pending_size = 0
+
+    #Starts run on first call: takes next run number by creating its index exclusively, so concurrent runs never share it
+    @staticmethod
+    def openSegment():
+        if RunLog.index is None:
+            import atexit
+            if not os.path.isdir(RunLog.getDir()):
+                os.makedirs(RunLog.getDir())
+            run = (RunLog.getRuns() or [0])[-1] + 1
+            while True:
+                try:
+                    os.close(os.open(RunLog.getIndexPath(run), os.O_WRONLY | os.O_CREAT | os.O_EXCL, int('644', 8)))
+                    break
+                except OSError:
+                    if not os.path.exists(RunLog.getIndexPath(run)):
+                        raise
+                    run += 1
+            RunLog.index = {'run': run, 'start': time.strftime('%Y-%m-%d %H:%M:%S'), 'pid': os.getpid(),
+                            'args': sys.argv[1:], 'segments': [], 'artifacts': dict()}
+            atexit.register(RunLog.close)
+        elif RunLog.segment and (RunLog.segment_size >= options.log_segment_size * 1024 * 1024
+                                 or time.time() - RunLog.segment_started >= RunLog.segment_age):
+            RunLog.segment.close()
+            RunLog.segment = None
+        if RunLog.segment is None:
+            name = 'run-%06d-%d.log.gz' % (RunLog.index['run'], len(RunLog.index['segments']))
+            RunLog.segment = open(os.path.join(RunLog.getDir(), name), 'wb')
+            RunLog.index['segments'].append(name)
+            RunLog.segment_size = 0
+            RunLog.segment_started = time.time()
+            RunLog.prune()
+
+    @staticmethod
+    def writeIndex():
+        import json
+        writeFileAtomically(RunLog.getIndexPath(RunLog.index['run']), json.dumps(RunLog.index, sort_keys=True))
+
+    #Removes oldest segments (except the current one) while they are too old or too large together,
+    #index of other run is removed with its last segment
+    @staticmethod
+    def prune():
+        import re
+        directory = RunLog.getDir()
+        segments = list()
+        for name in os.listdir(directory):
+            match = re.match(r'run-(\d+)-(\d+)\.log\.gz$', name)
+            if match:
+                stat = os.stat(os.path.join(directory, name))
+                segments.append((int(match.group(1)), int(match.group(2)), name, stat.st_size, stat.st_mtime))
+        total = sum(segment[3] for segment in segments)
+        oldest = time.time() - options.log_max_age * 24 * 3600
+        current = RunLog.index['segments'][-1]
+        for (run, part, name, size, modified) in sorted(segments):
+            if name != current and (modified < oldest or total > options.log_max_size * 1024 * 1024):
+                os.remove(os.path.join(directory, name))
+                total -= size
+        remaining = set(int(name.split('-')[1]) for name in os.listdir(directory) if name.endswith('.log.gz'))
+        for run in RunLog.getRuns():
+            if run not in remaining and run != RunLog.index['run']:
+                os.remove(RunLog.getIndexPath(run))
+
+    @staticmethod
+    def close():
+        with output_lock:
+            RunLog.flush()
+            if RunLog.segment and not RunLog.disabled:
+                RunLog.index['end'] = time.strftime('%Y-%m-%d %H:%M:%S')
+                RunLog.writeIndex()
+                RunLog.segment.close()
+                RunLog.segment = None
+
+    #Keys of artifacts of index matching arguments: '*', 'organisation/name', name, glob or part of name
+    @staticmethod
+    def matchKeys(index, args):
+        import fnmatch
+        keys = sorted(key for key in index['artifacts'] if key != RunLog.global_key)
+        matched = list()
+        for arg in args:
+            if arg == RunLog.global_key:
+                found = [RunLog.global_key]
+            else:
+                found = [key for key in keys if arg in (key, os.path.basename(key))]
+                found = found or [key for key in keys if fnmatch.fnmatch(key, arg) or fnmatch.fnmatch(os.path.basename(key), arg)]
+                found = found or [key for key in keys if arg.lower() in os.path.basename(key).lower()]
+            matched.extend(key for key in found if key not in matched and key in index['artifacts'])
+        return matched
+
+    #Decompressed blocks of artifact, segments removed by rotation are skipped
+    @staticmethod
+    def read(index, key):
+        import zlib
+        files = dict()
+        try:
+            for (segment, offset, length) in index['artifacts'].get(key, []):
+                name = index['segments'][segment]
+                if name not in files:
+                    path = os.path.join(RunLog.getDir(), name)
+                    files[name] = os.path.isfile(path) and open(path, 'rb') or None
+                    if files[name] is None:
+                        yield ('[log segment %s was removed by rotation]\n' % name).encode('utf-8')
+                if files[name]:
+                    files[name].seek(offset)
+                    yield zlib.decompress(files[name].read(length), 16 + zlib.MAX_WBITS)
+        finally:
+            for log_file in files.values():
+                if log_file:
+                    log_file.close()
+
+#Prints output of artifacts (--logs ARTIFACT) in last run which has it or in run --run N, without arguments lists runs
+def showLogs(args):
+    RunLog.disabled = True #reading logs doesn't start a run
+    runs = RunLog.getRuns()
+    if options.run:
+        if options.run not in runs:
+            print('Run %d is not in %s' % (options.run, RunLog.getDir()))
+            return 1
+        runs = [options.run]
+    if not args:
+        for run in runs:
+            index = RunLog.loadIndex(run)
+            if index:
+                print('%6d  %s  %3d artifacts  %s' % (run, index['start'],
+                      len([key for key in index['artifacts'] if key != RunLog.global_key]), ' '.join(index['args'])))
+        return 0
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    for run in reversed(runs):
+        index = RunLog.loadIndex(run)
+        keys = index and RunLog.matchKeys(index, args)
+        if not keys:
+            continue
+        print('Run %d started %s: %s' % (run, index['start'], ' '.join(index['args'])))
+        for key in keys:
+            if len(keys) > 1:
+                print('[%s]' % key)
+            sys.stdout.flush()
+            for block in RunLog.read(index, key):
+                output.write(block)
+            output.flush()
+        return 0
+    print('No logs of %s%s in %s' % (' '.join(args), options.run and ' in run %d' % options.run or '', RunLog.getDir()))
+    return 1
 
 def showDetailedInfo(path=os.getcwd()):
     for repo in Repository.artifacts:
@@ -465,10 +3136,10 @@ def showDetailedInfo(path=os.getcwd()):
             print(repo.getAbsoluteLocationDir())
             print(repo.getCurrentBranchGitHubUrl())
             print("Logs:")
-            call('git --no-pager log --pretty=format:"%an %ar %B" -n 5')
+            call('git --no-pager log --pretty=format:"%an %ar %B" -n 5', prefix=False)
 
 def gitLog(artifact):
-    call('git --no-pager log --pretty=format:"%an %ar %B" -n 1')
+    call('git --no-pager log --pretty=format:"%an %ar %B" -n 1', prefix=False)
 
 def listDirs(artifact):
     print(artifact.getAbsoluteLocationDir())
@@ -477,13 +3148,17 @@ def listBranchUrls(artifact):
     print(artifact.getCurrentBranchGitHubUrl())
 
 #Binds commandline key and longKey to callback function
-def addCliArgument(parser, key, longKey, help, action, silentMode=False, changedir=True, printName=False, gitUpdate=False):
-    parser.add_option(key, longKey, action="store_const",
+def addCliArgument(parser, key, longKey, help, action, silentMode=False, changedir=True, printName=False, gitUpdate=False, incremental=False, parallel=False):
+    keys = [name for name in (key, longKey) if name]
+    parser.add_option(*keys, action="store_const",
         const=longKey, dest="action", help=help)
     if isinstance(action, str):
-        Repository.addAction(MavenGoal(longKey, action, gitUpdate=gitUpdate))
+        Repository.addAction(MavenGoal(longKey, action, gitUpdate=gitUpdate, incremental=incremental))
+    elif isinstance(action, Action):
+        action.name = longKey
+        Repository.addAction(action)
     else:
-        Repository.addAction(Action(longKey, action, silentMode=silentMode, changedir=changedir, printName=printName))
+        Repository.addAction(Action(longKey, action, silentMode=silentMode, changedir=changedir, printName=printName, parallel=parallel))
 
 def main():
     from optparse import OptionParser
@@ -504,14 +3179,92 @@ def main():
         help="Clone or update artifacts")
     parser.add_option("-U", "--update-rebase", action="store_true", dest="rebase", default=False,
         help="Clone or update artifacts and rebase to master. Merge conflicts may occur while rebasing")
+    parser.add_option("--pre-resolve", action="store_true", dest="pre_resolve", default=False,
+        help="Resolve dependencies of all selected artifacts in one parallel pass (like -x) before running maven goal")
+    parser.add_option("--online", action="store_true", dest="online", default=False,
+        help="Don't run maven offline (-o) for artifacts whose dependencies were resolved by -x or --pre-resolve")
+    parser.add_option("--executor", type="choice", choices=['subprocess', 'daemon'], dest="executor", default='subprocess',
+        help="Run maven as new process for every build (subprocess, default) or with warm maven daemons (daemon)")
+    parser.add_option("--daemon-command", dest="daemon_command", default='mvnd',
+        help="Maven daemon client used by --executor daemon (default mvnd)", metavar="COMMAND")
+    parser.add_option("--daemon-pool", type="int", dest="daemon_pool",
+        help="Number of maven daemons (default: --jobs)", metavar="N")
+    parser.add_option("--daemon-max-builds", type="int", dest="daemon_max_builds", default=50,
+        help="Restart maven daemon after N builds (default 50)", metavar="N")
+    parser.add_option("--daemon-max-memory", type="int", dest="daemon_max_memory",
+        help="Restart maven daemon when its resident memory exceeds MB", metavar="MB")
+    parser.add_option("--serve", dest="serve",
+        help="Run as worker of distributed mode: accept jobs of coordinator on PORT (localhost:PORT, other hosts need --secret-file)", metavar="[HOST:]PORT")
+    parser.add_option("--secret-file", dest="secret_file",
+        help="Shared secret of workers and coordinator of distributed mode, required by workers listening on other than localhost", metavar="FILE")
+    parser.add_option("--workers", dest="workers",
+        help="Run as coordinator of distributed mode: run update and action of selected artifacts on these workers", metavar="HOST:PORT,HOST:PORT")
+    parser.add_option("--retries", type="int", dest="retries", default=2,
+        help="Retry job of lost worker on other workers N times (default 2)", metavar="N")
+    parser.add_option("--worker-timeout", type="int", dest="worker_timeout", default=60,
+        help="Worker is lost if it doesn't respond for SECONDS (default 60)", metavar="SECONDS")
+    parser.add_option("--plan", action="store_true", dest="plan", default=False,
+        help="Don't run anything, print predicted build order and time of maven goal based on durations of previous builds")
+    parser.add_option("--resume", action="store_true", dest="resume", default=False,
+        help="Repeat last run (selection, action, -u/-U) from journal, skipping what succeeded in it")
+    parser.add_option("--budget", action="store_true", dest="budget", default=False,
+        help="Share cores and memory of this machine between concurrent maven builds: -T threads for multi-module builds and MAVEN_OPTS heap")
+    parser.add_option("--budget-cpus", type="int", dest="budget_cpus",
+        help="Cores shared by maven builds (sets --budget, default: all cores)", metavar="N")
+    parser.add_option("--budget-memory", type="int", dest="budget_memory",
+        help="Memory in MB for heaps of maven builds (sets --budget, default: 60%% of physical memory)", metavar="MB")
+    parser.add_option("--logs", action="store_true", dest="logs", default=False,
+        help="Print logged output of artifacts given as arguments from last run which has them (or from --run N). Without arguments lists logged runs")
+    parser.add_option("--run", type="int", dest="run",
+        help="Run whose output is printed by --logs", metavar="N")
+    parser.add_option("--log-segment-size", type="int", dest="log_segment_size", default=16,
+        help="Start new compressed log segment after MB (default 16)", metavar="MB")
+    parser.add_option("--log-max-size", type="int", dest="log_max_size", default=512,
+        help="Remove oldest log segments when all of them take more than MB (default 512)", metavar="MB")
+    parser.add_option("--log-max-age", type="int", dest="log_max_age", default=30,
+        help="Remove log segments older than DAYS (default 30)", metavar="DAYS")
+    parser.add_option("--tail-lines", type="int", dest="tail_lines", default=30,
+        help="Number of last output lines of failed commands shown at the end of run", metavar="N")
+    parser.add_option("--profile", action="store_true", dest="profile", default=False,
+        help="Show slowest artifacts, phases and commands and write Chrome trace-event JSON (see --trace)")
+    parser.add_option("--trace", dest="trace_file",
+        help="Trace file written by --profile (default: APPS_DIR/mvnrepo-updater-trace.json)", metavar="FILE")
+    parser.add_option("--json", action="store_true", dest="json", default=False,
+        help="Print --status result as JSON")
+    parser.add_option("--mirror-dir", dest="mirror_dir",
+        help="Keep bare mirrors of repositories in this dir; clones, pulls and fork fetches use them", metavar="MIRROR_DIR")
+    parser.add_option("--depth", type="int", dest="depth",
+        help="Clone repositories with history truncated to DEPTH commits (shallow clone)", metavar="DEPTH")
+    parser.add_option("--filter", dest="clone_filter",
+        help="Partial clone, e.g. --filter=blob:none downloads file contents on demand", metavar="FILTER_SPEC")
+    parser.add_option("--single-branch", action="store_true", dest="single_branch", default=False,
+        help="Clone only default branch, other upstream branches are fetched when they are selected")
+    parser.add_option("--sparse", dest="sparse",
+        help="Sparse checkout of comma separated module dirs (files of repository root are always checked out)", metavar="PATH,PATH")
+    parser.add_option("--fetch-ttl", type="int", dest="fetch_ttl", default=60,
+        help="Don't fetch remote for branch switch if it was fetched less than SECONDS ago (default 60)", metavar="SECONDS")
+    parser.add_option("--watch", action="store_true", dest="watch", default=False,
+        help="Keep running: poll upstream of artifacts and update (and run action on) only changed ones")
+    parser.add_option("--interval", type="int", dest="interval", default=300,
+        help="Poll interval of --watch mode (default 300)", metavar="SECONDS")
+    parser.add_option("--queue-size", type="int", dest="queue_size", default=100,
+        help="Max number of changed repositories queued in --watch mode (default 100)", metavar="N")
+    parser.add_option("--status-file", dest="status_file",
+        help="Status of --watch mode (default: APPS_DIR/.mvnrepo-updater.status.json)", metavar="FILE")
+    parser.add_option("--force", action="store_true", dest="force", default=False,
+        help="Run maven goals even for artifacts not changed since last successful build")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=None,
+        help="Number of artifacts cloned/updated/built in parallel. Maven builds respect dependencies between artifacts", metavar="N")
 
     addCliArgument(parser, "-l", "--dir",    help="List artifacts location dirs", action=listDirs, silentMode=True, changedir=False)
     addCliArgument(parser, "-L", "--branch", help="List urls of github branches", action=listBranchUrls, silentMode=True)
     addCliArgument(parser, "-i", "--info",   help="Show info on last commits in working copy: author, date, message", action=gitLog, silentMode=True, printName=True)
-    addCliArgument(parser, "-s", "--status", help="Show all artifacts with uncommitted changes", action=listStatus, silentMode=True)
-    addCliArgument(parser, "-x", "--resolve",help="Resolve all maven dependencies", action='dependency:resolve dependency:resolve-plugins')
-    addCliArgument(parser, "-d", "--deploy", help="Deploy artifacts", action='clean deploy', gitUpdate=True)
-    addCliArgument(parser, "-t", "--test",   help="Run tests", action='clean test')
+    addCliArgument(parser, "-s", "--status", help="Show all artifacts with uncommitted changes or unpushed/unpulled commits", action=StatusScan())
+    addCliArgument(parser, "-x", "--resolve",help="Resolve all maven dependencies and plugins of artifacts in one parallel pass", action=DependencyResolution())
+    addCliArgument(parser, "-d", "--deploy", help="Deploy artifacts", action='clean deploy', gitUpdate=True, incremental=True)
+    addCliArgument(parser, "-t", "--test",   help="Run tests", action='clean test', incremental=True)
+    addCliArgument(parser, None, "--mirror-refresh", help="Fetch upstream and fork remotes of artifacts into mirror dir", action=refreshMirror, changedir=False, parallel=True)
+    addCliArgument(parser, None, "--mirror-gc", help="Run git gc in mirrors of artifacts", action=gcMirror, changedir=False, parallel=True)
     addCliArgument(parser, "-c", "--clean",  help="Resolve all maven dependencies", action='-o clean')
 
     (parsed_options, args) = parser.parse_args()
@@ -528,28 +3281,58 @@ def main():
             options.resetGitRepos = False
             options.action = None
 
-    import datetime
-    now = datetime.datetime.now()
-    log2file('\n\t[%s]' % now.strftime("%Y-%m-%d %H:%M"))
+    if options.logs:
+        return showLogs(args)
     initArtifacts()
+    if options.github_username and not isSafeRefName(options.github_username):
+        fatal('Invalid github username: ' + options.github_username)
+        return 1
+    if options.resume:
+        resumeLastRun()
+        return finish(args)
+    if options.serve:
+        try:
+            Worker(options.serve).serve()
+        except KeyboardInterrupt:
+            log2file('Worker stopped')
+        return 0
     if not len(args) and (options.action == '--dir' or options.action == '--branch' or options.action == '--info'
-        or options.action == '--status' or options.action == '--resolve' or options.action == '--clean'):
+        or options.action == '--status' or options.action == '--resolve' or options.action == '--clean'
+        or options.action == '--mirror-refresh' or options.action == '--mirror-gc'):
         options.debug_mode = False
         args.append('*')
     elif not len(args):
         showDetailedInfo()
         exit(0)
+    if options.watch:
+        action = Repository.getAction(options.action)
+        if not (isinstance(action, MavenGoal) and action.gitUpdate): #-d updates artifacts itself
+            options.update = options.update or not options.rebase
+        selection = selectArtifacts(args)
+        try:
+            Watcher(selection).run()
+        except KeyboardInterrupt:
+            log2file('Watch mode stopped')
+            return 0
     doAction(args)
+    return finish(args)
 
+#Logs options of finished run and shows its warnings, failures and profile, returns exit code (1 if a command failed)
+def finish(args):
     log2file("options: " + str(options))
     log2file("artifacts: " + str(args))
 
     if options.debug_mode:
         showExecutedCommands()
     showWarnings()
-    log2file('All actions finished successfully')
-    log_file.close()
-    return 0
+    showFailures()
+    showProfile()
+    if failures:
+        log2file('Actions finished, %d commands failed' % len(failures))
+    else:
+        log2file('All actions finished successfully')
+    RunLog.close()
+    return failures and 1 or 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())